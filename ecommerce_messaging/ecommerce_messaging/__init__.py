@@ -0,0 +1,3 @@
+# Event envelope and RabbitMQ consumer infrastructure shared by the
+# shipping, order and product services. Install it into each service with
+# ``pip install ./ecommerce_messaging`` from the repository root.
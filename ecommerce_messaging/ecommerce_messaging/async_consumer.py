@@ -0,0 +1,249 @@
+# asyncio consumer engine shared by the order and product services.
+import time, signal, asyncio, logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from pika.spec import Basic
+from pika.adapters.asyncio_connection import AsyncioConnection
+from pika.exceptions import ConnectionClosedByClient
+from .messaging import (
+    RETRY_DELAYS,
+    RetryRouter,
+    connection_parameters,
+    declare_queue,
+    event_type_of,
+    to_delivery,
+)
+from .metrics import ConsumerMetrics
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncConsumer:
+    """
+    Consume messages on pika's AsyncioConnection.
+
+    Each message is handled in its own task; at most ``concurrency`` are in
+    flight (this is also the prefetch window). ``handler(deliveries)`` is
+    the same batch handler the blocking BatchConsumer uses, called with a
+    single delivery through ``sync_to_async`` on a pool of ``db_threads``
+    threads, so the event loop never waits on the database. Failed messages
+    go through a RetryRouter on the confirm-mode channel and are acked once
+    the broker confirms their copy, or requeued if it nacks or returns it. Throughput, latency
+    and queue depth are recorded in ``metrics``. With a PrefetchController
+    as ``flow``, the prefetch follows handler latency and new messages wait
+    while the database is too slow.
+    """
+
+    def __init__(self, host, user, password, queue, exchange, routing_keys, handler,
+                 concurrency=64, db_threads=8, retry_delays=RETRY_DELAYS,
+                 metrics=None, depth_interval=15.0, flow=None):
+        self.parameters = connection_parameters(host, user, password)
+        self.queue = queue
+        self.exchange = exchange
+        self.routing_keys = routing_keys
+        self.handler = handler
+        self.concurrency = concurrency
+        self.retry_delays = retry_delays
+        self.retries = RetryRouter(queue, retry_delays)
+        self.metrics = metrics or ConsumerMetrics()
+        self.depth_interval = depth_interval
+        self.flow = flow
+
+        self._executor = ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="consumer-db")
+        self._handle = sync_to_async(self._handle_sync, thread_sensitive=False, executor=self._executor)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._resume = asyncio.Event()
+        self._resume.set()
+        self._tasks = set()
+        self._loop = None
+        self._connection = None
+        self._channel = None
+        self._consumer_tag = None
+        self._closed = None
+
+        # Retry/DLQ copies awaiting their broker confirm, by publish sequence number
+        self._confirms = OrderedDict()  # delivery tag -> (future, message id)
+        self._returned = set()  # message ids returned as unroutable, awaiting their confirm
+        self._next_publish_tag = 1
+
+    # ------------------------
+    # Connection lifecycle
+    # ------------------------
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._closed = self._loop.create_future()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self._loop.add_signal_handler(sig, lambda: asyncio.ensure_future(self.stop()))
+
+        opened = self._loop.create_future()
+        self._connection = AsyncioConnection(
+            self.parameters,
+            on_open_callback=lambda conn: opened.set_result(conn),
+            on_open_error_callback=lambda conn, err: opened.set_exception(err),
+            on_close_callback=self._on_connection_closed,
+            custom_ioloop=self._loop,
+        )
+        await opened
+
+        channel_opened = self._loop.create_future()
+        self._connection.channel(on_open_callback=channel_opened.set_result)
+        self._channel = await channel_opened
+        self._channel.add_on_close_callback(self._on_channel_closed)
+        self._channel.add_on_return_callback(self._on_return)
+        confirming = self._loop.create_future()
+        self._channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=confirming.set_result)
+        await confirming
+
+        declare_queue(self._channel, self.queue, self.exchange, self.routing_keys, self.retry_delays)
+        prefetch = self.flow.prefetch if self.flow is not None else self.concurrency
+        self._set_prefetch(prefetch)
+        self._consumer_tag = self._channel.basic_consume(self.queue, self._on_message)
+        logger.info(f"Async consumer listening on {self.queue} (concurrency={self.concurrency})")
+
+        poller = self._loop.create_task(self._poll_queue_depth())
+        try:
+            await self._closed
+        finally:
+            poller.cancel()
+            self._executor.shutdown(wait=True)
+
+    async def _poll_queue_depth(self):
+        while True:
+            for queue in (self.queue, f"{self.queue}.dlq"):
+                if self._channel is None or not self._channel.is_open:
+                    break
+                declared = self._loop.create_future()
+                self._channel.queue_declare(queue=queue, passive=True, callback=declared.set_result)
+                frame = await declared
+                self.metrics.set_queue_depth(queue, frame.method.message_count)
+            await asyncio.sleep(self.depth_interval)
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Channel closed: {reason}")
+        # Copies never confirmed: their originals stay unacked and are redelivered
+        while self._confirms:
+            _, (future, _) = self._confirms.popitem(last=False)
+            if not future.done():
+                future.set_result(False)
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        if self._closed.done():
+            return
+        if isinstance(reason, ConnectionClosedByClient):
+            self._closed.set_result(None)
+        else:
+            # Lost the broker: let the caller's retry reconnect
+            self._closed.set_exception(reason)
+
+    async def stop(self):
+        """Stop consuming, let in-flight handlers finish, then close."""
+        if self._channel is not None and self._channel.is_open and self._consumer_tag:
+            logger.info("Shutdown requested, waiting for in-flight messages")
+            self._channel.basic_cancel(self._consumer_tag)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+
+    # ------------------------
+    # Retry publishing
+    # ------------------------
+    def _on_return(self, channel, method, properties, body):
+        logger.warning(f"Retry copy returned: routing_key={method.routing_key} ({method.reply_text})")
+        self._returned.add(properties.message_id)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [tag for tag in self._confirms if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        for tag in tags:
+            future, message_id = self._confirms.pop(tag, (None, None))
+            if future is None:
+                continue
+            returned = message_id in self._returned
+            self._returned.discard(message_id)
+            if not future.done():
+                future.set_result(isinstance(method, Basic.Ack) and not returned)
+
+    async def _route(self, channel, delivery, error):
+        """Publish the retry/DLQ copy of ``delivery``; True once the broker has confirmed it."""
+        target, properties = self.retries.prepare(delivery, error)
+        confirmed = asyncio.get_running_loop().create_future()
+        self._confirms[self._next_publish_tag] = (confirmed, properties.message_id)
+        self._next_publish_tag += 1
+        channel.basic_publish(
+            exchange="", routing_key=target, body=delivery.body, properties=properties, mandatory=True,
+        )
+        if not await confirmed:
+            logger.error(f"Broker did not take message {delivery.delivery_tag} for {target}")
+            return False
+        return True
+
+    # ------------------------
+    # Message handling
+    # ------------------------
+    def _handle_sync(self, delivery):
+        close_old_connections()
+        start = time.monotonic()
+        try:
+            self.handler([delivery])
+        finally:
+            self.metrics.observe_handler(time.monotonic() - start)
+
+    def _on_message(self, channel, method, properties, body):
+        delivery = to_delivery(method, properties, body)
+        self.metrics.record_received(event_type_of(delivery), delivery.redelivered)
+        task = self._loop.create_task(self._process(channel, delivery))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _process(self, channel, delivery):
+        async with self._semaphore:
+            error = None
+            if delivery.event is None:
+                error = "undecodable message"
+            else:
+                await self._resume.wait()
+                start = time.monotonic()
+                try:
+                    await self._handle(delivery)
+                except Exception as e:
+                    logger.exception(f"Failed to process message: {delivery.body} | Error: {e}")
+                    error = e
+                if self.flow is not None:
+                    self._apply_flow(time.monotonic() - start)
+            if not channel.is_open:
+                return  # unacked, the broker redelivers it
+            if error is not None:
+                self.metrics.record_failed(event_type_of(delivery))
+                if not await self._route(channel, delivery, error):
+                    if channel.is_open:
+                        channel.basic_nack(delivery_tag=delivery.delivery_tag, requeue=True)
+                    return
+            channel.basic_ack(delivery_tag=delivery.delivery_tag)
+            if delivery.received_at is not None:
+                self.metrics.observe_ack(time.monotonic() - delivery.received_at)
+
+    def _set_prefetch(self, prefetch):
+        # Channel-wide like BatchConsumer: a per-consumer limit would not
+        # apply to the consumer that is already running
+        self._channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+        self.metrics.set_prefetch(prefetch)
+
+    def _apply_flow(self, latency):
+        prefetch = self.flow.observe(latency)
+        if prefetch is not None and self._channel is not None and self._channel.is_open:
+            self._set_prefetch(prefetch)
+        if self.flow.should_pause and self._resume.is_set():
+            logger.warning(
+                f"Handler latency {self.flow.latency * 1000:.0f}ms, pausing {self.flow.pause_seconds}s"
+            )
+            self.metrics.record_pause()
+            self._resume.clear()
+            asyncio.get_running_loop().call_later(self.flow.pause_seconds, self._resume.set)
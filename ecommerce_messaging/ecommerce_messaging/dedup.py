@@ -0,0 +1,125 @@
+# Event de-duplication shared by the order and product consumers.
+import time, logging, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+from django.db import transaction
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+def event_id_of(delivery):
+    """The event id of a delivery, falling back to the AMQP message_id for legacy bodies."""
+    return delivery.event.get("id") or getattr(delivery.properties, "message_id", None)
+
+
+class RecentEvents:
+    """Thread-safe LRU set of recently processed event ids."""
+
+    def __init__(self, capacity=100_000):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, event_id):
+        with self._lock:
+            if event_id not in self._ids:
+                return False
+            self._ids.move_to_end(event_id)
+            return True
+
+    def add(self, event_ids):
+        with self._lock:
+            for event_id in event_ids:
+                self._ids[event_id] = None
+                self._ids.move_to_end(event_id)
+            while len(self._ids) > self.capacity:
+                self._ids.popitem(last=False)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class EventDeduplicator:
+    """
+    Skip events that were already applied.
+
+    Recently seen ids are answered from an in-memory LRU without touching
+    the database. The rest are checked against the service's ``model``
+    (``event_id`` unique, ``event_type``, indexed ``processed_at``) with one
+    query per batch, and the ids of applied events are inserted in
+    the same transaction as their side effects. A redelivery racing the
+    original on another worker hits the unique constraint and rolls back,
+    so it is retried and then recognised as a duplicate. Rows older than
+    ``ttl`` are purged every ``purge_interval`` seconds.
+
+    Events without an id (published before envelopes existed) are always
+    applied.
+    """
+
+    def __init__(self, model, cache_size=100_000, ttl=timedelta(days=7), purge_interval=3600):
+        self.model = model
+        self.recent = RecentEvents(cache_size)
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._next_purge = time.monotonic() + purge_interval
+
+    def filter_new(self, deliveries):
+        """Return the deliveries whose events have not been applied yet."""
+        fresh, seen = [], set()
+        for delivery in deliveries:
+            event_id = event_id_of(delivery)
+            if event_id is not None:
+                if event_id in seen or event_id in self.recent:
+                    logger.info(f"Skipping duplicate event {event_id}")
+                    continue
+                seen.add(event_id)
+            fresh.append(delivery)
+
+        if seen:
+            known = set(
+                self.model.objects.filter(event_id__in=seen).values_list("event_id", flat=True)
+            )
+            if known:
+                logger.info(f"Skipping {len(known)} already processed events: {sorted(known)}")
+                self.recent.add(known)
+                fresh = [d for d in fresh if event_id_of(d) not in known]
+        return fresh
+
+    def record(self, deliveries):
+        """Insert the ids of applied events; call inside the transaction that applied them."""
+        rows = [
+            self.model(event_id=event_id_of(d), event_type=d.event["type"])
+            for d in deliveries
+            if event_id_of(d) is not None
+        ]
+        if rows:
+            self.model.objects.bulk_create(rows)
+            transaction.on_commit(lambda: self.recent.add(row.event_id for row in rows))
+
+    @contextmanager
+    def processing(self, deliveries):
+        """
+        Apply ``deliveries`` exactly once.
+
+        Opens a transaction, yields the deliveries that are new and records
+        them when the block completes.
+        """
+        with transaction.atomic():
+            fresh = self.filter_new(deliveries)
+            yield fresh
+            self.record(fresh)
+        self.purge_expired()
+
+    def purge_expired(self, force=False):
+        """Delete processed-event rows older than the TTL, at most every ``purge_interval``."""
+        if not force and time.monotonic() < self._next_purge:
+            return 0
+        self._next_purge = time.monotonic() + self.purge_interval
+        deleted, _ = self.model.objects.filter(
+            processed_at__lt=timezone.now() - self.ttl
+        ).delete()
+        if deleted:
+            logger.info(f"Purged {deleted} processed events older than {self.ttl}")
+        return deleted
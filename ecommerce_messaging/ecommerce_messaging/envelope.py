@@ -0,0 +1,93 @@
+# Event envelope shared by the shipping, order and product services.
+import json, time, uuid
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - plain json fallback
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - msgpack is optional
+    msgpack = None
+
+SCHEMA_VERSION = 1
+
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_MSGPACK = "application/msgpack"
+
+
+class EnvelopeError(ValueError):
+    """The message body could not be decoded into an event envelope."""
+
+
+def build_envelope(event_type, data, event_id=None, timestamp=None):
+    """Wrap event data with schema version, event id and timestamp."""
+    return {
+        "v": SCHEMA_VERSION,
+        "id": str(event_id or uuid.uuid4()),
+        "type": event_type,
+        "ts": timestamp if timestamp is not None else time.time(),
+        "data": data,
+    }
+
+
+def encode(envelope, content_type=CONTENT_TYPE_JSON):
+    """Serialize an envelope to bytes using the codec for ``content_type``."""
+    if content_type == CONTENT_TYPE_MSGPACK:
+        if msgpack is None:
+            raise EnvelopeError("msgpack is not installed")
+        return msgpack.packb(envelope, use_bin_type=True)
+    if content_type == CONTENT_TYPE_JSON:
+        if orjson is not None:
+            return orjson.dumps(envelope)
+        return json.dumps(envelope, separators=(",", ":")).encode()
+    raise EnvelopeError(f"Unsupported content type: {content_type}")
+
+
+def _sniff_content_type(body):
+    # Messages replayed without AMQP properties: msgpack maps start with
+    # 0x80-0x8f (fixmap), 0xde or 0xdf; JSON objects with "{"
+    first = body[:1]
+    if first and (0x80 <= first[0] <= 0x8F or first[0] in (0xDE, 0xDF)):
+        return CONTENT_TYPE_MSGPACK
+    return CONTENT_TYPE_JSON
+
+
+def decode(body, content_type=None):
+    """
+    Decode a message body into an envelope dict.
+
+    The codec is picked from the AMQP ``content_type`` property, falling back
+    to sniffing the body. Bodies published before envelopes existed
+    (``{"type": ..., "data": ...}``) are upgraded to version 0 envelopes
+    without an event id.
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    content_type = content_type or _sniff_content_type(body)
+
+    try:
+        if content_type == CONTENT_TYPE_MSGPACK:
+            if msgpack is None:
+                raise EnvelopeError("msgpack is not installed")
+            message = msgpack.unpackb(body, raw=False)
+        elif orjson is not None:
+            message = orjson.loads(body)
+        else:
+            message = json.loads(body)
+    except EnvelopeError:
+        raise
+    except Exception as e:
+        raise EnvelopeError(f"Cannot decode {content_type} body: {e}") from e
+
+    if not isinstance(message, dict) or "type" not in message:
+        raise EnvelopeError("Message is not an event envelope")
+
+    return {
+        "v": message.get("v", 0),
+        "id": message.get("id"),
+        "type": message["type"],
+        "ts": message.get("ts"),
+        "data": message.get("data") or {},
+    }
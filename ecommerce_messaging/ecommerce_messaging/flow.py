@@ -0,0 +1,62 @@
+# Adaptive consumer flow control shared by the order and product services.
+import time, logging
+
+logger = logging.getLogger(__name__)
+
+
+class PrefetchController:
+    """
+    AIMD prefetch sizing driven by handler (database) latency.
+
+    Handler latencies are smoothed with an exponentially weighted moving
+    average. At most once per ``adjust_interval`` seconds the prefetch
+    grows by ``increase`` while the average stays under
+    ``target_latency``, and is multiplied by ``decrease`` once it goes
+    over, always within ``[min_prefetch, max_prefetch]``. Above
+    ``pause_latency`` the consumer should stop taking work for
+    ``pause_seconds`` so the database can catch up.
+    """
+
+    def __init__(self, min_prefetch, max_prefetch, target_latency=0.25, pause_latency=2.0,
+                 pause_seconds=1.0, increase=1, decrease=0.5, smoothing=0.2, adjust_interval=1.0):
+        if not 1 <= min_prefetch <= max_prefetch:
+            raise ValueError(f"Invalid prefetch bounds [{min_prefetch}, {max_prefetch}]")
+        self.min_prefetch = min_prefetch
+        self.max_prefetch = max_prefetch
+        self.target_latency = target_latency
+        self.pause_latency = pause_latency
+        self.pause_seconds = pause_seconds
+        self.increase = increase
+        self.decrease = decrease
+        self.smoothing = smoothing
+        self.adjust_interval = adjust_interval
+
+        self.prefetch = max_prefetch
+        self.latency = None
+        self._next_adjust = 0.0
+
+    def observe(self, latency):
+        """Record one handler latency; return the new prefetch if it changed, else None."""
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.smoothing * (latency - self.latency)
+
+        now = time.monotonic()
+        if now < self._next_adjust:
+            return None
+        self._next_adjust = now + self.adjust_interval
+
+        if self.latency > self.target_latency:
+            prefetch = max(self.min_prefetch, int(self.prefetch * self.decrease))
+        else:
+            prefetch = min(self.max_prefetch, self.prefetch + self.increase)
+        if prefetch == self.prefetch:
+            return None
+        logger.info(f"Prefetch {self.prefetch} -> {prefetch} (handler latency {self.latency * 1000:.0f}ms)")
+        self.prefetch = prefetch
+        return prefetch
+
+    @property
+    def should_pause(self):
+        return self.latency is not None and self.latency > self.pause_latency
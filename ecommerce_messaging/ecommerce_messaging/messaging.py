@@ -0,0 +1,385 @@
+# RabbitMQ consumer plumbing shared by the order and product services.
+import time, uuid, signal, logging, threading
+from collections import namedtuple
+import pika
+from pika.exceptions import ChannelClosedByBroker, NackError, UnroutableError
+from .envelope import decode, EnvelopeError
+from .metrics import ConsumerMetrics
+
+logger = logging.getLogger(__name__)
+
+# A received message together with its decoded envelope
+Delivery = namedtuple(
+    "Delivery", ["delivery_tag", "redelivered", "properties", "body", "event", "received_at"],
+    defaults=(None,),
+)
+
+# Highest AMQP message priority the service queues honour (publishers use 0-9)
+MAX_PRIORITY = 10
+
+# Delay tiers (seconds) for retrying failed messages before they go to the DLQ
+RETRY_DELAYS = (1, 10, 60)
+
+ATTEMPTS_HEADER = "x-attempts"
+ERROR_HEADER = "x-error"
+
+
+def to_delivery(method, properties, body):
+    """Decode a received message; ``event`` is None if it is not a valid envelope."""
+    try:
+        event = decode(body, properties.content_type)
+    except EnvelopeError as e:
+        logger.error(f"Undecodable message skipped: {body!r} | Error: {e}")
+        event = None
+    return Delivery(method.delivery_tag, method.redelivered, properties, body, event, time.monotonic())
+
+
+def event_type_of(delivery):
+    return delivery.event["type"] if delivery.event is not None else "<undecodable>"
+
+
+def connection_parameters(host, user, password):
+    return pika.ConnectionParameters(host=host, credentials=pika.PlainCredentials(user, password))
+
+
+def connect(host, user, password):
+    return pika.BlockingConnection(connection_parameters(host, user, password))
+
+
+def retry_queue_name(queue, delay):
+    return f"{queue}.retry.{delay}s"
+
+
+def declare_queue(channel, queue, exchange, routing_keys, retry_delays=RETRY_DELAYS):
+    """
+    Ensure the topic exchange, this service's queue, its retry queues and
+    its Dead Letter Queue (DLQ) exist, and bind the queue to the event
+    types it handles.
+
+    The main queue is a priority queue, so high-priority events (set per
+    event type by the publisher) are delivered ahead of a backlog.
+
+    Retry queues have no consumers: messages sit there for the queue's TTL
+    and are then dead-lettered back onto the main queue.
+    """
+    channel.exchange_declare(exchange=exchange, exchange_type="topic", durable=True)
+    dlq_name = f"{queue}.dlq"
+    channel.queue_declare(queue=dlq_name, durable=True)
+    args = {
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": dlq_name,
+        "x-max-priority": MAX_PRIORITY,
+    }
+    channel.queue_declare(queue=queue, durable=True, arguments=args)
+    for delay in retry_delays:
+        channel.queue_declare(
+            queue=retry_queue_name(queue, delay),
+            durable=True,
+            arguments={
+                "x-message-ttl": int(delay * 1000),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": queue,
+            },
+        )
+    for routing_key in routing_keys:
+        channel.queue_bind(queue=queue, exchange=exchange, routing_key=routing_key)
+
+
+def _move_messages(channel, source, target):
+    """Republish everything ready in ``source`` to ``target``, acking each message once confirmed."""
+    moved = 0
+    while True:
+        method, properties, body = channel.basic_get(queue=source, auto_ack=False)
+        if method is None:
+            return moved
+        # Confirm mode + mandatory: raises instead of dropping the message
+        channel.basic_publish(exchange="", routing_key=target, body=body, properties=properties, mandatory=True)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        moved += 1
+
+
+def migrate_queue(connection, legacy, queue, exchange, routing_keys, retry_delays=RETRY_DELAYS, poll_interval=1.0):
+    """
+    Retire ``legacy`` (e.g. a queue declared before it needed new arguments
+    such as ``x-max-priority``) in favour of ``queue`` without losing
+    messages. Returns the number of messages moved.
+
+    ``queue`` must already be declared and bound. The legacy queue is
+    unbound first, so from then on events only reach ``queue``; events
+    published while both were bound reach both, and the second copy is
+    skipped by de-duplication. Its ready messages and its DLQ are then
+    moved over with publisher confirms until its retry tiers have
+    dead-lettered everything back, and the empty legacy queues are deleted.
+    If that takes longer than the longest retry delay, the legacy queues
+    are left in place (unbound) for the next start to finish.
+    """
+    channel = connection.channel()
+    try:
+        channel.queue_declare(queue=legacy, passive=True)
+    except ChannelClosedByBroker:
+        return 0  # never existed, or already migrated
+    channel.confirm_delivery()
+    retry_queues = [retry_queue_name(legacy, delay) for delay in retry_delays]
+
+    try:
+        for routing_key in routing_keys:
+            channel.queue_unbind(queue=legacy, exchange=exchange, routing_key=routing_key)
+
+        moved = 0
+        deadline = time.monotonic() + max(retry_delays, default=0) + poll_interval
+        while True:
+            moved += _move_messages(channel, legacy, queue)
+            moved += _move_messages(channel, f"{legacy}.dlq", f"{queue}.dlq")
+            waiting = sum(
+                channel.queue_declare(queue=name, passive=True).method.message_count for name in retry_queues
+            )
+            if not waiting:
+                break
+            if time.monotonic() >= deadline:
+                logger.warning(f"{waiting} messages still in {legacy} retry queues, finishing on next start")
+                return moved
+            connection.sleep(poll_interval)
+
+        for name in [legacy, *retry_queues, f"{legacy}.dlq"]:
+            channel.queue_delete(queue=name, if_empty=True)
+    except ChannelClosedByBroker as e:
+        # Another worker migrated it first (404) or a queue is not empty yet
+        # (406); unacked messages went back to their queue
+        logger.warning(f"Migration of {legacy} interrupted: {e}")
+        return 0
+    finally:
+        if channel.is_open:
+            channel.close()
+    logger.info(f"Migrated {moved} messages from {legacy} to {queue} and deleted {legacy}")
+    return moved
+
+
+class RetryRouter:
+    """
+    Send failed messages to the next delay queue, or to the DLQ.
+
+    The number of failed attempts travels in the ``x-attempts`` header and
+    the last error in ``x-error``. A message that failed once waits in the
+    first delay tier, after ``len(retry_delays)`` retries it lands in
+    ``<queue>.dlq``. Undecodable messages go straight to the DLQ. Copies
+    are published as mandatory on a confirm-mode channel, and the caller
+    acks the original delivery only once the broker has confirmed its copy;
+    otherwise it requeues the original, so a failure is never lost.
+    """
+
+    def __init__(self, queue, retry_delays=RETRY_DELAYS):
+        self.queue = queue
+        self.retry_delays = tuple(retry_delays)
+
+    @staticmethod
+    def attempts(delivery):
+        headers = getattr(delivery.properties, "headers", None) or {}
+        return int(headers.get(ATTEMPTS_HEADER, 0))
+
+    def prepare(self, delivery, error):
+        """Target queue and properties of the retry or dead-letter copy of ``delivery``."""
+        attempts = self.attempts(delivery) + 1
+        if delivery.event is not None and attempts <= len(self.retry_delays):
+            target = retry_queue_name(self.queue, self.retry_delays[attempts - 1])
+        else:
+            target = f"{self.queue}.dlq"
+
+        properties = delivery.properties
+        headers = dict(getattr(properties, "headers", None) or {})
+        headers[ATTEMPTS_HEADER] = attempts
+        headers[ERROR_HEADER] = str(error)[:1000]
+        logger.warning(f"Message {delivery.delivery_tag} failed (attempt {attempts}), sending to {target}: {error}")
+        return target, pika.BasicProperties(
+            content_type=getattr(properties, "content_type", None),
+            # Returned copies are matched to their confirm by message id
+            message_id=getattr(properties, "message_id", None) or uuid.uuid4().hex,
+            type=getattr(properties, "type", None),
+            timestamp=getattr(properties, "timestamp", None),
+            priority=getattr(properties, "priority", None),
+            headers=headers,
+            delivery_mode=2,  # Persistent
+        )
+
+    def route(self, channel, delivery, error):
+        """
+        Republish ``delivery`` on a confirm-mode BlockingChannel. Returns the
+        target queue, or None if the broker nacked or returned the copy.
+        """
+        target, properties = self.prepare(delivery, error)
+        try:
+            channel.basic_publish(
+                exchange="", routing_key=target, body=delivery.body, properties=properties, mandatory=True,
+            )
+        except (NackError, UnroutableError) as e:
+            logger.error(f"Broker did not take message {delivery.delivery_tag} for {target}: {e!r}")
+            return None
+        return target
+
+
+def poll_queue_depth(channel, queues, metrics):
+    """Record the ready-message count of ``queues`` with passive declares."""
+    for queue in queues:
+        result = channel.queue_declare(queue=queue, passive=True)
+        metrics.set_queue_depth(queue, result.method.message_count)
+
+
+class BatchConsumer:
+    """
+    Consume messages in batches.
+
+    Sets a channel-wide ``basic_qos(prefetch_count=batch_size)`` and
+    collects up to ``batch_size`` messages or ``max_wait`` seconds,
+    whichever comes first.
+    The whole batch goes to ``handler(deliveries)`` at once and is then
+    acked with a single ``basic_ack(multiple=True)``. If the batch handler
+    raises, the messages are retried one by one so a single bad message
+    cannot hold back the rest; messages that still fail are handed to a
+    RetryRouter (the channel is put in confirm mode for it) before the
+    batch is acked. A failed message whose copy the broker did not confirm
+    is requeued instead of acked.
+
+    Throughput, latency and queue depth (polled every ``depth_interval``
+    seconds) are recorded in ``metrics``. With a PrefetchController as
+    ``flow``, the prefetch (and so the batch size) follows handler latency
+    between its bounds, and consumption pauses while the database is slow.
+
+    SIGTERM/SIGINT (or ``stop()``) finish and ack the batch in progress,
+    then cancel the consumer so unprocessed prefetched messages are
+    requeued for other workers.
+    """
+
+    def __init__(self, channel, queue, handler, batch_size=100, max_wait=0.2, retry_delays=RETRY_DELAYS,
+                 metrics=None, depth_interval=15.0, flow=None):
+        self.channel = channel
+        self.queue = queue
+        self.handler = handler
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.retries = RetryRouter(queue, retry_delays)
+        self.metrics = metrics or ConsumerMetrics()
+        self.depth_interval = depth_interval
+        self._next_depth_poll = 0.0
+        self.flow = flow
+        self.prefetch = flow.prefetch if flow is not None else batch_size
+        self._stopping = False
+
+    def stop(self, *_):
+        logger.info("Shutdown requested, draining current batch")
+        self._stopping = True
+
+    def run(self):
+        in_main_thread = threading.current_thread() is threading.main_thread()
+        if in_main_thread:
+            previous = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            self._consume()
+        finally:
+            if in_main_thread:
+                for sig, handler in previous.items():
+                    signal.signal(sig, handler)
+
+    def _consume(self):
+        self._set_prefetch(self.prefetch)
+        self.channel.confirm_delivery()
+
+        batch, deadline = [], None
+        for method, properties, body in self.channel.consume(
+            self.queue, inactivity_timeout=self.max_wait
+        ):
+            if self._stopping:
+                # Hand a message that arrived after the stop request back to the queue
+                if method is not None:
+                    self.channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                break
+
+            if time.monotonic() >= self._next_depth_poll:
+                poll_queue_depth(self.channel, [self.queue, f"{self.queue}.dlq"], self.metrics)
+                self._next_depth_poll = time.monotonic() + self.depth_interval
+
+            if method is not None:
+                delivery = to_delivery(method, properties, body)
+                self.metrics.record_received(event_type_of(delivery), delivery.redelivered)
+                batch.append(delivery)
+                if deadline is None:
+                    deadline = time.monotonic() + self.max_wait
+
+            if batch and (
+                len(batch) >= self.prefetch
+                or method is None
+                or time.monotonic() >= deadline
+            ):
+                self.flush(batch)
+                batch, deadline = [], None
+
+        if batch:
+            self.flush(batch)
+        requeued = self.channel.cancel()
+        logger.info(f"Consumer stopped, {requeued} prefetched messages requeued")
+
+    def flush(self, batch):
+        deliveries = [d for d in batch if d.event is not None]
+        failed = [(d, "undecodable message") for d in batch if d.event is None]
+        try:
+            if deliveries:
+                self._call_handler(deliveries)
+        except Exception as e:
+            logger.exception(f"Batch of {len(batch)} failed, retrying one by one | Error: {e}")
+            for delivery in deliveries:
+                try:
+                    self._call_handler([delivery])
+                except Exception as e:
+                    logger.exception(f"Failed to process message: {delivery.body} | Error: {e}")
+                    failed.append((delivery, e))
+
+        unrouted = set()
+        for delivery, error in failed:
+            self.metrics.record_failed(event_type_of(delivery))
+            if self.retries.route(self.channel, delivery, error) is None:
+                unrouted.add(delivery.delivery_tag)
+        if unrouted:
+            # No confirmed copy: hand those back to the queue, ack the rest one by one
+            for delivery in batch:
+                if delivery.delivery_tag in unrouted:
+                    self.channel.basic_nack(delivery_tag=delivery.delivery_tag, requeue=True)
+                else:
+                    self.channel.basic_ack(delivery_tag=delivery.delivery_tag)
+        else:
+            self.channel.basic_ack(delivery_tag=batch[-1].delivery_tag, multiple=True)
+
+        now = time.monotonic()
+        for delivery in batch:
+            if delivery.received_at is not None:
+                self.metrics.observe_ack(now - delivery.received_at)
+
+        if self.flow is not None:
+            self._apply_flow()
+
+    def _call_handler(self, deliveries):
+        start = time.monotonic()
+        try:
+            self.handler(deliveries)
+        finally:
+            elapsed = time.monotonic() - start
+            self.metrics.observe_handler(elapsed)
+            if self.flow is not None:
+                self.flow.observe(elapsed)
+
+    def _set_prefetch(self, prefetch):
+        # Channel-wide (global) QoS: RabbitMQ applies a per-consumer limit only
+        # to consumers created after basic_qos, so changing it on a running
+        # consumer would never shrink the broker's window. There is one
+        # consumer per channel, so the two are otherwise the same.
+        self.prefetch = prefetch
+        self.channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+        self.metrics.set_prefetch(prefetch)
+
+    def _apply_flow(self):
+        if self.flow.prefetch != self.prefetch:
+            self._set_prefetch(self.flow.prefetch)
+        if self.flow.should_pause:
+            logger.warning(
+                f"Handler latency {self.flow.latency * 1000:.0f}ms, pausing {self.flow.pause_seconds}s"
+            )
+            self.metrics.record_pause()
+            # Keeps servicing heartbeats while we wait
+            self.channel.connection.sleep(self.flow.pause_seconds)
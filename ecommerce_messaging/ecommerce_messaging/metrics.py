@@ -0,0 +1,157 @@
+# Consumer metrics in Prometheus text format, shared by the order and product services.
+import os, bisect, logging, threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram; not thread-safe on its own, guarded by ConsumerMetrics."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels=""):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else repr(float(bound))
+            lines.append(f'{name}_bucket{{{labels}{"," if labels else ""}le="{le}"}} {cumulative}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+
+def _labels(**labels):
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+
+class ConsumerMetrics:
+    """
+    Thread-safe consumer instrumentation.
+
+    Counts received messages, redeliveries and failures per event type and
+    keeps histograms of handler latency (per handler call) and ack latency
+    (receipt to ack, per message), plus the last polled depth of each
+    queue. ``render`` returns the Prometheus text exposition format;
+    rates such as messages/sec come from ``rate()`` over the counters.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self._lock = threading.Lock()
+        self.received = defaultdict(int)
+        self.redelivered = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.handler_latency = Histogram(buckets)
+        self.ack_latency = Histogram(buckets)
+        self.queue_depth = {}
+        self.prefetch = None
+        self.pauses = 0
+
+    def record_received(self, event_type, redelivered=False):
+        with self._lock:
+            self.received[event_type] += 1
+            if redelivered:
+                self.redelivered[event_type] += 1
+
+    def record_failed(self, event_type):
+        with self._lock:
+            self.failed[event_type] += 1
+
+    def observe_handler(self, seconds):
+        with self._lock:
+            self.handler_latency.observe(seconds)
+
+    def observe_ack(self, seconds):
+        with self._lock:
+            self.ack_latency.observe(seconds)
+
+    def set_queue_depth(self, queue, depth):
+        with self._lock:
+            self.queue_depth[queue] = depth
+
+    def set_prefetch(self, prefetch):
+        with self._lock:
+            self.prefetch = prefetch
+
+    def record_pause(self):
+        with self._lock:
+            self.pauses += 1
+
+    def render(self):
+        with self._lock:
+            lines = []
+            for name, help_text, values in (
+                ("consumer_messages_total", "Messages received, by event type.", self.received),
+                ("consumer_redeliveries_total", "Redelivered messages received, by event type.", self.redelivered),
+                ("consumer_failures_total", "Messages whose handling failed, by event type.", self.failed),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                lines += [f"{name}{{{_labels(type=t)}}} {v}" for t, v in sorted(values.items())]
+
+            for name, help_text, histogram in (
+                ("consumer_handler_seconds", "Time spent in the event handler per call.", self.handler_latency),
+                ("consumer_ack_latency_seconds", "Time from receiving a message to acking it.", self.ack_latency),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                lines += histogram.render(name)
+
+            lines += ["# HELP consumer_queue_depth Ready messages in the queue at the last poll.",
+                      "# TYPE consumer_queue_depth gauge"]
+            lines += [f"consumer_queue_depth{{{_labels(queue=q)}}} {d}" for q, d in sorted(self.queue_depth.items())]
+
+            if self.prefetch is not None:
+                lines += ["# HELP consumer_prefetch Current basic_qos prefetch count.",
+                          "# TYPE consumer_prefetch gauge",
+                          f"consumer_prefetch {self.prefetch}"]
+            lines += ["# HELP consumer_pauses_total Times consumption was paused for database latency.",
+                      "# TYPE consumer_pauses_total counter",
+                      f"consumer_pauses_total {self.pauses}"]
+            return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = self.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # scrapes would flood the consumer log
+
+
+_server = None
+_server_pid = None
+
+
+def serve_metrics(metrics, port):
+    """Serve ``metrics`` on ``http://0.0.0.0:<port>/metrics`` from a daemon thread, once per process."""
+    global _server, _server_pid
+    if _server is not None and _server_pid == os.getpid():
+        return _server
+    handler = type("MetricsHandler", (_MetricsHandler,), {"metrics": metrics})
+    _server = ThreadingHTTPServer(("0.0.0.0", port), handler)
+    _server_pid = os.getpid()
+    threading.Thread(target=_server.serve_forever, name="consumer-metrics", daemon=True).start()
+    logger.info(f"Consumer metrics on :{port}/metrics")
+    return _server
@@ -0,0 +1,109 @@
+# Multi-process consumer supervisor shared by the order and product services.
+import os, time, signal, logging, multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+def _worker_main(target, slot):
+    # Forked children inherit the supervisor's handlers: restore defaults and
+    # leave Ctrl-C to the supervisor, which forwards SIGTERM to every worker.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Lets the worker pick per-worker resources, e.g. its metrics port
+    os.environ["CONSUMER_WORKER_SLOT"] = str(slot)
+    logger.info(f"Consumer worker {slot} started (pid={os.getpid()})")
+    target()
+
+
+class Supervisor:
+    """
+    Run ``target`` in ``workers`` forked processes and keep them running.
+
+    Each worker opens its own RabbitMQ and database connections. Crashed
+    workers are restarted with exponential backoff (reset once a worker has
+    stayed up for ``stable_after`` seconds); a worker that exits cleanly is
+    restarted right away. On SIGTERM/SIGINT the workers
+    get SIGTERM so they finish their current batch and requeue the rest;
+    any still alive after ``shutdown_timeout`` seconds are killed.
+    """
+
+    def __init__(self, target, workers, max_backoff=60, stable_after=30, shutdown_timeout=30):
+        self.target = target
+        self.workers = workers
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.shutdown_timeout = shutdown_timeout
+
+        self._ctx = multiprocessing.get_context("fork")
+        self._procs = {}  # slot -> (process, started_at)
+        self._failures = {slot: 0 for slot in range(workers)}
+        self._restart_at = {}
+        self._stopping = False
+
+    def _request_stop(self, *_):
+        logger.info("Supervisor shutting down workers")
+        self._stopping = True
+
+    def _spawn(self, slot):
+        # Never share the parent's DB sockets with forked children
+        from django.db import connections
+        connections.close_all()
+
+        process = self._ctx.Process(
+            target=_worker_main, args=(self.target, slot), name=f"consumer-worker-{slot}"
+        )
+        process.start()
+        self._procs[slot] = (process, time.monotonic())
+
+    def _reap(self):
+        now = time.monotonic()
+        for slot, (process, started_at) in list(self._procs.items()):
+            if process.is_alive():
+                if now - started_at >= self.stable_after:
+                    self._failures[slot] = 0
+                continue
+
+            process.join()
+            del self._procs[slot]
+            if process.exitcode == 0:
+                delay = 0  # not a crash
+            else:
+                self._failures[slot] += 1
+                delay = min(self.max_backoff, 2 ** (self._failures[slot] - 1))
+            self._restart_at[slot] = now + delay
+            logger.warning(
+                f"Consumer worker {slot} exited with code {process.exitcode}, restarting in {delay}s"
+            )
+
+        for slot, restart_at in list(self._restart_at.items()):
+            if now >= restart_at:
+                del self._restart_at[slot]
+                self._spawn(slot)
+
+    def _shutdown(self):
+        for process, _ in self._procs.values():
+            if process.is_alive():
+                process.terminate()  # SIGTERM -> graceful drain
+
+        deadline = time.monotonic() + self.shutdown_timeout
+        for process, _ in self._procs.values():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"{process.name} did not stop in time, killing it")
+                process.kill()
+                process.join()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+
+        logger.info(f"Starting {self.workers} consumer workers")
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        while not self._stopping:
+            self._reap()
+            time.sleep(0.5)
+
+        self._shutdown()
+        logger.info("All consumer workers stopped")
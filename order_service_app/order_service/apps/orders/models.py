@@ -30,3 +30,16 @@ class Order(models.Model):
     class Meta:
         ordering = ["-created_at"]
         db_table = "orders"
+
+
+class ProcessedEvent(models.Model):
+    """Id of an event the consumer has already applied (see ecommerce_messaging.dedup)."""
+    event_id = models.CharField(max_length=64, unique=True)
+    event_type = models.CharField(max_length=50)
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
+
+    class Meta:
+        db_table = "processed_events"
@@ -0,0 +1,303 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import pytest
+from pika.exceptions import NackError
+from pika.spec import Basic
+from ecommerce_messaging.async_consumer import AsyncConsumer
+from apps.orders.consumer import handle_batch
+from ecommerce_messaging.envelope import build_envelope, encode
+from ecommerce_messaging.messaging import BatchConsumer, Delivery, RetryRouter, declare_queue, migrate_queue
+from apps.orders.models import Order
+
+
+def delivery(tag, event_type, **data):
+    return Delivery(tag, False, None, b"", build_envelope(event_type, data))
+
+
+def make_order(**kwargs):
+    return Order.objects.create(user_id=1, product_id=1, **kwargs)
+
+
+@pytest.mark.django_db
+def test_handle_batch_updates_all_orders_in_one_statement(django_assert_num_queries):
+    first, second = make_order(), make_order()
+
+    with django_assert_num_queries(5):  # SAVEPOINT + dedup SELECT + UPDATE + dedup INSERT + RELEASE
+        handle_batch([
+            delivery(1, "shipment.paid", order_id=first.id),
+            delivery(2, "shipment.paid", order_id=second.id),
+            delivery(3, "shipment.updated", shipment_id=9),
+        ])
+
+    first.refresh_from_db()
+    second.refresh_from_db()
+    assert first.status == Order.Status.PAID
+    assert second.status == Order.Status.PAID
+
+
+@pytest.mark.django_db
+def test_handle_batch_ignores_missing_orders():
+    order = make_order()
+
+    handle_batch([
+        delivery(1, "shipment.shipped", order_id=order.id),
+        delivery(2, "shipment.shipped", order_id=order.id + 100),
+    ])
+
+    order.refresh_from_db()
+    assert order.status == Order.Status.SHIPPED
+
+
+@pytest.mark.django_db
+def test_handle_batch_folds_events_per_order_into_furthest_status(django_assert_num_queries):
+    order = make_order()
+
+    with django_assert_num_queries(5):  # still a single UPDATE
+        handle_batch([
+            delivery(1, "shipment.shipped", order_id=order.id),
+            delivery(2, "shipment.paid", order_id=order.id),  # arrived out of order
+        ])
+
+    order.refresh_from_db()
+    assert order.status == Order.Status.SHIPPED
+
+
+@pytest.mark.django_db
+def test_handle_batch_never_moves_an_order_backwards():
+    shipped = make_order(status=Order.Status.SHIPPED)
+    cancelled = make_order(status=Order.Status.CANCELLED)
+
+    handle_batch([
+        delivery(1, "shipment.paid", order_id=shipped.id),
+        delivery(2, "shipment.shipped", order_id=cancelled.id),
+    ])
+
+    shipped.refresh_from_db()
+    cancelled.refresh_from_db()
+    assert shipped.status == Order.Status.SHIPPED
+    assert cancelled.status == Order.Status.CANCELLED
+
+
+def test_declare_queue_binds_only_handled_event_types():
+    channel = MagicMock()
+
+    declare_queue(channel, "orders", "shipping_events", ["shipment.paid", "shipment.shipped"])
+
+    channel.exchange_declare.assert_called_once_with(
+        exchange="shipping_events", exchange_type="topic", durable=True
+    )
+    declared = {c.kwargs["queue"]: c.kwargs.get("arguments") for c in channel.queue_declare.call_args_list}
+    assert declared["orders"]["x-max-priority"] == 10
+    bound = [c.kwargs["routing_key"] for c in channel.queue_bind.call_args_list]
+    assert bound == ["shipment.paid", "shipment.shipped"]
+    assert all(c.kwargs["queue"] == "orders" for c in channel.queue_bind.call_args_list)
+
+
+def test_batch_consumer_acks_batch_with_multiple():
+    channel = MagicMock()
+    properties = SimpleNamespace(content_type="application/json")
+    body = encode(build_envelope("shipment.paid", {"order_id": 1}))
+    channel.consume.return_value = [
+        (SimpleNamespace(delivery_tag=tag, redelivered=False), properties, body)
+        for tag in (1, 2, 3)
+    ]
+    handler = MagicMock()
+
+    BatchConsumer(channel, "shipping_events", handler, batch_size=3).run()
+
+    channel.basic_qos.assert_called_once_with(prefetch_count=3, global_qos=True)
+    assert len(handler.call_args.args[0]) == 3
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_batch_consumer_retries_failed_batch_one_by_one():
+    channel = MagicMock()
+    handler = MagicMock(side_effect=[RuntimeError("deadlock"), None, RuntimeError("bad"), None])
+    batch = [delivery(tag, "shipment.paid", order_id=tag) for tag in (1, 2, 3)]
+
+    BatchConsumer(channel, "orders", handler).flush(batch)
+
+    assert handler.call_count == 4
+    # Only the message that failed on its own goes to the first retry tier
+    channel.basic_publish.assert_called_once()
+    published = channel.basic_publish.call_args.kwargs
+    assert published["routing_key"] == "orders.retry.1s"
+    assert published["mandatory"]
+    assert published["properties"].headers["x-attempts"] == 1
+    channel.basic_ack.assert_called_once_with(delivery_tag=3, multiple=True)
+
+
+def test_batch_consumer_requeues_failed_message_whose_retry_copy_is_nacked():
+    channel = MagicMock()
+    channel.basic_publish.side_effect = NackError([])
+    handler = MagicMock(side_effect=[RuntimeError("deadlock"), None, RuntimeError("bad"), None])
+    batch = [delivery(tag, "shipment.paid", order_id=tag) for tag in (1, 2, 3)]
+
+    BatchConsumer(channel, "orders", handler).flush(batch)
+
+    # The failure is neither lost nor acked: it goes back to the queue, the rest are acked
+    channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=True)
+    assert [c.kwargs for c in channel.basic_ack.call_args_list] == [{"delivery_tag": 1}, {"delivery_tag": 3}]
+
+
+def test_retry_router_moves_through_tiers_then_to_dlq():
+    channel = MagicMock()
+    router = RetryRouter("orders", retry_delays=(1, 10))
+    message = delivery(1, "shipment.paid", order_id=1)
+
+    targets = []
+    for _ in range(3):
+        targets.append(router.route(channel, message, RuntimeError("db down")))
+        message = message._replace(properties=channel.basic_publish.call_args.kwargs["properties"])
+
+    assert targets == ["orders.retry.1s", "orders.retry.10s", "orders.dlq"]
+    assert message.properties.headers == {"x-attempts": 3, "x-error": "db down"}
+
+
+def test_retry_router_sends_undecodable_message_straight_to_dlq():
+    channel = MagicMock()
+    broken = Delivery(1, False, None, b"not json", None)
+
+    assert RetryRouter("orders").route(channel, broken, "undecodable message") == "orders.dlq"
+
+
+def test_retry_router_reports_unconfirmed_copy():
+    channel = MagicMock()
+    channel.basic_publish.side_effect = NackError([])
+
+    assert RetryRouter("orders").route(channel, delivery(1, "shipment.paid", order_id=1), "db down") is None
+
+
+def test_declare_queue_creates_retry_queues_that_return_to_main_queue():
+    channel = MagicMock()
+
+    declare_queue(channel, "orders", "shipping_events", [], retry_delays=(1, 60))
+
+    declared = {c.kwargs["queue"]: c.kwargs.get("arguments") for c in channel.queue_declare.call_args_list}
+    assert declared["orders.retry.60s"] == {
+        "x-message-ttl": 60000,
+        "x-dead-letter-exchange": "",
+        "x-dead-letter-routing-key": "orders",
+    }
+
+
+def test_batch_consumer_drains_batch_on_stop():
+    channel = MagicMock()
+    properties = SimpleNamespace(content_type="application/json")
+    body = encode(build_envelope("shipment.paid", {"order_id": 1}))
+    handler = MagicMock()
+    consumer = BatchConsumer(channel, "shipping_events", handler, batch_size=10)
+
+    def deliveries():
+        yield SimpleNamespace(delivery_tag=1, redelivered=False), properties, body
+        consumer.stop()
+        yield SimpleNamespace(delivery_tag=2, redelivered=False), properties, body
+
+    channel.consume.return_value = deliveries()
+    consumer.run()
+
+    # The batch in progress is processed and acked, the late message requeued
+    assert len(handler.call_args.args[0]) == 1
+    channel.basic_ack.assert_called_once_with(delivery_tag=1, multiple=True)
+    channel.basic_nack.assert_called_once_with(delivery_tag=2, requeue=True)
+    channel.cancel.assert_called_once()
+
+
+def test_async_consumer_handles_each_message_off_the_loop_and_acks_it():
+    channel = MagicMock(is_open=True)
+    threads = []
+    handler = MagicMock(side_effect=lambda batch: threads.append(threading.current_thread().name))
+    consumer = AsyncConsumer(
+        "rabbitmq", "guest", "guest", "orders", "shipping_events", ["shipment.paid"], handler, concurrency=2
+    )
+
+    async def process():
+        await asyncio.gather(*[
+            consumer._process(channel, delivery(tag, "shipment.paid", order_id=tag)) for tag in (1, 2, 3)
+        ])
+
+    asyncio.run(process())
+
+    assert handler.call_count == 3
+    assert all(len(call.args[0]) == 1 for call in handler.call_args_list)
+    assert all(name.startswith("consumer-db") for name in threads)
+    assert sorted(c.kwargs["delivery_tag"] for c in channel.basic_ack.call_args_list) == [1, 2, 3]
+
+
+def confirming_channel(consumer, confirm=Basic.Ack, returned=False):
+    """Channel mock whose publishes the broker confirms with ``confirm``, after returning them if ``returned``."""
+    channel = MagicMock(is_open=True)
+    published = []
+
+    def basic_publish(**kwargs):
+        published.append(kwargs)
+        if returned:
+            consumer._on_return(channel, SimpleNamespace(routing_key=kwargs["routing_key"], reply_text="NO_ROUTE"),
+                                kwargs["properties"], kwargs["body"])
+        frame = SimpleNamespace(method=confirm(delivery_tag=len(published)))
+        asyncio.get_running_loop().call_soon(consumer._on_confirm, frame)
+
+    channel.basic_publish.side_effect = basic_publish
+    return channel
+
+
+def failing_consumer():
+    return AsyncConsumer(
+        "rabbitmq", "guest", "guest", "orders", "shipping_events", ["shipment.paid"],
+        MagicMock(side_effect=RuntimeError("bad")),
+    )
+
+
+def test_async_consumer_schedules_retry_and_acks_when_handler_fails():
+    consumer = failing_consumer()
+    channel = confirming_channel(consumer)
+
+    asyncio.run(consumer._process(channel, delivery(7, "shipment.paid", order_id=1)))
+
+    assert channel.basic_publish.call_args.kwargs["routing_key"] == "orders.retry.1s"
+    assert channel.basic_publish.call_args.kwargs["mandatory"]
+    channel.basic_ack.assert_called_once_with(delivery_tag=7)
+
+
+@pytest.mark.parametrize("confirm, returned", [(Basic.Nack, False), (Basic.Ack, True)], ids=["nacked", "returned"])
+def test_async_consumer_requeues_failed_message_when_retry_copy_is_not_confirmed(confirm, returned):
+    consumer = failing_consumer()
+    channel = confirming_channel(consumer, confirm, returned)
+
+    asyncio.run(consumer._process(channel, delivery(7, "shipment.paid", order_id=1)))
+
+    channel.basic_ack.assert_not_called()
+    channel.basic_nack.assert_called_once_with(delivery_tag=7, requeue=True)
+    assert not consumer._confirms and not consumer._returned
+
+
+def test_migrate_queue_moves_legacy_messages_before_deleting_it():
+    connection = MagicMock()
+    channel = connection.channel.return_value
+    ready = {"old": [b"a", b"b"], "old.dlq": [b"dead"]}
+    waiting = iter([1, 0, 0, 0])  # old.retry.1s holds one message on the first check
+
+    def basic_get(queue, auto_ack):
+        if ready.get(queue):
+            return SimpleNamespace(delivery_tag=queue), "props", ready[queue].pop(0)
+        return None, None, None
+
+    channel.basic_get.side_effect = basic_get
+    channel.queue_declare.side_effect = lambda queue, passive: SimpleNamespace(
+        method=SimpleNamespace(message_count=next(waiting) if queue == "old.retry.1s" else 0)
+    )
+
+    moved = migrate_queue(connection, "old", "new", "shipping_events", ["shipment.paid"], retry_delays=(1,))
+
+    assert moved == 3
+    channel.queue_unbind.assert_called_once_with(queue="old", exchange="shipping_events", routing_key="shipment.paid")
+    published = [(c.kwargs["routing_key"], c.kwargs["body"]) for c in channel.basic_publish.call_args_list]
+    assert published == [("new", b"a"), ("new", b"b"), ("new.dlq", b"dead")]
+    assert all(c.kwargs["mandatory"] for c in channel.basic_publish.call_args_list)
+    assert channel.basic_ack.call_count == 3
+    connection.sleep.assert_called_once()
+    deleted = [c.kwargs["queue"] for c in channel.queue_delete.call_args_list]
+    assert deleted == ["old", "old.retry.1s", "old.dlq"]
+    assert all(c.kwargs["if_empty"] for c in channel.queue_delete.call_args_list)
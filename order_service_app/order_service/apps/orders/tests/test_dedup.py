@@ -0,0 +1,73 @@
+from datetime import timedelta
+from unittest.mock import patch
+import pytest
+from django.utils import timezone
+from apps.orders.consumer import handle_batch
+from ecommerce_messaging.dedup import EventDeduplicator, RecentEvents
+from ecommerce_messaging.envelope import build_envelope
+from ecommerce_messaging.messaging import Delivery
+from apps.orders.models import Order, ProcessedEvent
+
+
+def delivery(tag, event_type, event_id=None, **data):
+    return Delivery(tag, False, None, b"", build_envelope(event_type, data, event_id=event_id))
+
+
+def test_recent_events_evicts_least_recently_used():
+    recent = RecentEvents(capacity=2)
+    recent.add(["a", "b"])
+    assert "a" in recent  # touch "a" so "b" is the oldest
+    recent.add(["c"])
+
+    assert "a" in recent
+    assert "b" not in recent
+    assert "c" in recent
+
+
+@pytest.mark.django_db(transaction=True)
+def test_redelivered_event_is_applied_once():
+    order = Order.objects.create(user_id=1, product_id=1)
+    event = delivery(1, "shipment.paid", event_id="evt-1", order_id=order.id)
+    dedup = EventDeduplicator(ProcessedEvent)
+
+    with dedup.processing([event, event]) as fresh:
+        assert fresh == [event]
+    assert ProcessedEvent.objects.filter(event_id="evt-1").exists()
+    assert "evt-1" in dedup.recent
+
+    # Answered from memory, no query needed
+    with dedup.processing([event]) as fresh:
+        assert fresh == []
+
+
+@pytest.mark.django_db
+def test_duplicate_known_only_to_the_database_is_skipped():
+    ProcessedEvent.objects.create(event_id="evt-2", event_type="shipment.paid")
+    dedup = EventDeduplicator(ProcessedEvent)
+
+    with dedup.processing([delivery(1, "shipment.paid", event_id="evt-2", order_id=1)]) as fresh:
+        assert fresh == []
+    assert "evt-2" in dedup.recent
+
+
+@pytest.mark.django_db
+def test_handle_batch_does_not_reapply_processed_event():
+    order = Order.objects.create(user_id=1, product_id=1)
+    handle_batch([delivery(1, "shipment.shipped", event_id="evt-3", order_id=order.id)])
+    Order.objects.filter(id=order.id).update(status=Order.Status.PENDING)
+
+    with patch("apps.orders.consumer.dedup", EventDeduplicator(ProcessedEvent)):  # fresh process, empty cache
+        handle_batch([delivery(2, "shipment.shipped", event_id="evt-3", order_id=order.id)])
+
+    order.refresh_from_db()
+    assert order.status == Order.Status.PENDING
+
+
+@pytest.mark.django_db
+def test_purge_expired_removes_rows_older_than_ttl():
+    old = ProcessedEvent.objects.create(event_id="old", event_type="shipment.paid")
+    ProcessedEvent.objects.filter(id=old.id).update(processed_at=timezone.now() - timedelta(days=8))
+    ProcessedEvent.objects.create(event_id="new", event_type="shipment.paid")
+
+    assert EventDeduplicator(ProcessedEvent, ttl=timedelta(days=7)).purge_expired(force=True) == 1
+    assert list(ProcessedEvent.objects.values_list("event_id", flat=True)) == ["new"]
@@ -0,0 +1,108 @@
+from unittest.mock import MagicMock, patch
+from ecommerce_messaging.async_consumer import AsyncConsumer
+from ecommerce_messaging.envelope import build_envelope
+from ecommerce_messaging.flow import PrefetchController
+from ecommerce_messaging.messaging import BatchConsumer, Delivery
+
+
+def controller(**kwargs):
+    return PrefetchController(10, 100, target_latency=0.25, pause_latency=2.0, adjust_interval=0, **kwargs)
+
+
+def test_prefetch_grows_additively_while_latency_is_low():
+    flow = controller()
+    flow.prefetch = 50
+
+    assert flow.observe(0.05) == 51
+    assert flow.observe(0.05) == 52
+
+
+def test_prefetch_halves_above_target_and_respects_bounds():
+    flow = controller(smoothing=1.0)
+
+    assert flow.observe(0.5) == 50
+    assert flow.observe(0.5) == 25
+    assert flow.observe(0.5) == 12
+    assert flow.observe(0.5) == 10
+    assert flow.observe(0.5) is None  # already at the floor
+
+
+def test_adjustments_are_rate_limited():
+    flow = PrefetchController(10, 100, adjust_interval=60)
+    flow.prefetch = 50
+
+    assert flow.observe(0.01) == 51
+    assert flow.observe(0.01) is None
+
+
+def test_pause_above_pause_latency():
+    flow = controller(smoothing=1.0)
+    flow.observe(0.5)
+    assert not flow.should_pause
+
+    flow.observe(3.0)
+    assert flow.should_pause
+
+
+class QosChannel(MagicMock):
+    """
+    RabbitMQ's prefetch semantics: a per-consumer limit (``global_qos=False``)
+    is fixed when a consumer is created, a channel-wide one applies at once.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.next_consumer_limit = 0
+        self.channel_limit = 0
+        self.consumer_limit = None
+        self.is_open = True
+
+    def basic_qos(self, prefetch_count=0, global_qos=False):
+        if global_qos:
+            self.channel_limit = prefetch_count
+        else:
+            self.next_consumer_limit = prefetch_count
+
+    def basic_consume(self, *args, **kwargs):
+        self.consumer_limit = self.next_consumer_limit
+        return "ctag"
+
+    @property
+    def in_flight_limit(self):
+        limits = [limit for limit in (self.consumer_limit, self.channel_limit) if limit]
+        return min(limits) if limits else None
+
+
+def test_batch_consumer_shrinks_the_brokers_window_and_pauses_on_slow_handler():
+    channel = QosChannel()
+    flow = controller(smoothing=1.0, pause_seconds=0.5)
+    consumer = BatchConsumer(channel, "orders", MagicMock(), batch_size=100, flow=flow)
+    consumer._set_prefetch(consumer.prefetch)
+    channel.basic_consume("orders", MagicMock())  # what channel.consume() does
+    assert channel.in_flight_limit == 100
+    batch = [Delivery(1, False, None, b"", build_envelope("shipment.paid", {"order_id": 1}))]
+
+    with patch("ecommerce_messaging.messaging.time.monotonic", side_effect=[0.0, 3.0, 3.0, 3.0]):
+        consumer.flush(batch)
+
+    assert channel.in_flight_limit == 50
+    assert consumer.prefetch == 50
+    channel.connection.sleep.assert_called_once_with(0.5)
+    assert consumer.metrics.pauses == 1
+
+
+def test_async_consumer_shrinks_the_brokers_window():
+    channel = QosChannel()
+    flow = controller(smoothing=1.0)
+    consumer = AsyncConsumer(
+        "rabbitmq", "guest", "guest", "orders", "shipping_events", ["shipment.paid"], MagicMock(), flow=flow
+    )
+    consumer._channel = channel
+    consumer._set_prefetch(flow.prefetch)
+    channel.basic_consume("orders", consumer._on_message)
+    assert channel.in_flight_limit == 100
+
+    consumer._apply_flow(0.5)
+
+    assert channel.in_flight_limit == 50
+    assert consumer.metrics.prefetch == 50
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+from urllib.request import urlopen
+from ecommerce_messaging.envelope import build_envelope, encode
+from ecommerce_messaging.messaging import BatchConsumer
+from ecommerce_messaging.metrics import ConsumerMetrics, Histogram, serve_metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value)
+
+    lines = histogram.render("latency")
+
+    assert lines[:3] == [
+        'latency_bucket{le="0.1"} 2',
+        'latency_bucket{le="1.0"} 3',
+        'latency_bucket{le="+Inf"} 4',
+    ]
+    assert lines[-1] == "latency_count 4"
+
+
+def test_render_exposes_counters_by_event_type_and_queue_depth():
+    metrics = ConsumerMetrics()
+    metrics.record_received("shipment.paid")
+    metrics.record_received("shipment.paid", redelivered=True)
+    metrics.record_failed("shipment.shipped")
+    metrics.set_queue_depth("orders", 42)
+
+    text = metrics.render()
+
+    assert 'consumer_messages_total{type="shipment.paid"} 2' in text
+    assert 'consumer_redeliveries_total{type="shipment.paid"} 1' in text
+    assert 'consumer_failures_total{type="shipment.shipped"} 1' in text
+    assert 'consumer_queue_depth{queue="orders"} 42' in text
+    assert "# TYPE consumer_handler_seconds histogram" in text
+
+
+def test_batch_consumer_records_throughput_latency_and_depth():
+    channel = MagicMock()
+    channel.queue_declare.return_value.method.message_count = 7
+    properties = SimpleNamespace(content_type="application/json")
+    body = encode(build_envelope("shipment.paid", {"order_id": 1}))
+    channel.consume.return_value = [
+        (SimpleNamespace(delivery_tag=tag, redelivered=tag == 2), properties, body) for tag in (1, 2)
+    ]
+    metrics = ConsumerMetrics()
+
+    BatchConsumer(channel, "orders", MagicMock(), batch_size=2, metrics=metrics).run()
+
+    assert metrics.received == {"shipment.paid": 2}
+    assert metrics.redelivered == {"shipment.paid": 1}
+    assert metrics.handler_latency.count == 1
+    assert metrics.ack_latency.count == 2
+    assert metrics.queue_depth == {"orders": 7, "orders.dlq": 7}
+
+
+def test_metrics_endpoint_serves_prometheus_text():
+    metrics = ConsumerMetrics()
+    metrics.record_received("shipment.paid")
+    server = serve_metrics(metrics, 0)
+    try:
+        response = urlopen(f"http://127.0.0.1:{server.server_port}/metrics")
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert 'consumer_messages_total{type="shipment.paid"} 1' in response.read().decode()
+    finally:
+        server.shutdown()
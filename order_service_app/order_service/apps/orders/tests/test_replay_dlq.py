@@ -0,0 +1,90 @@
+from io import StringIO
+from unittest.mock import MagicMock, patch
+import pika
+from django.core.management import call_command
+from ecommerce_messaging.envelope import build_envelope, encode
+
+
+def dead_letter(tag, event_type, error, ts=1_700_000_000):
+    properties = pika.BasicProperties(
+        content_type="application/json", headers={"x-attempts": 3, "x-error": error}
+    )
+    body = encode(build_envelope(event_type, {"order_id": tag}, timestamp=ts))
+    return pika.spec.Basic.GetOk(delivery_tag=tag), properties, body
+
+
+def run(messages, *args):
+    channel = MagicMock()
+    channel.queue_declare.return_value.method.message_count = len(messages)
+    channel.basic_get.side_effect = list(messages) + [(None, None, None)]
+    out = StringIO()
+    with patch("apps.orders.management.commands.replay_dlq.connect") as connect:
+        connect.return_value.channel.return_value = channel
+        call_command("replay_dlq", "--queue", "orders", *args, stdout=out)
+    return channel, out.getvalue()
+
+
+def test_dry_run_summarizes_without_touching_the_dlq():
+    channel, output = run(
+        [
+            dead_letter(1, "shipment.paid", "deadlock"),
+            dead_letter(2, "shipment.paid", "deadlock"),
+            dead_letter(3, "shipment.shipped", "timeout"),
+        ],
+        "--dry-run",
+    )
+
+    channel.basic_publish.assert_not_called()
+    channel.basic_ack.assert_not_called()
+    channel.basic_nack.assert_called_once_with(delivery_tag=3, multiple=True, requeue=True)
+    assert "2  shipment.paid  deadlock" in output
+    assert "1  shipment.shipped  timeout" in output
+    assert "Would replay 3 messages" in output
+
+
+def test_dry_run_only_peeks_at_the_head_of_the_dlq():
+    channel, output = run(
+        [dead_letter(tag, "shipment.paid", "deadlock") for tag in range(1, 6)], "--dry-run", "--peek", "2"
+    )
+
+    assert channel.basic_get.call_count == 2
+    channel.basic_nack.assert_called_once_with(delivery_tag=2, multiple=True, requeue=True)
+    assert "5 messages (dry run, peeking at 2)" in output
+    assert "Would replay 2 messages" in output
+
+
+def test_replay_republishes_matching_messages_with_fresh_attempts():
+    channel, output = run(
+        [
+            dead_letter(1, "shipment.paid", "deadlock"),
+            dead_letter(2, "shipment.shipped", "timeout"),
+            dead_letter(3, "shipment.paid", "deadlock", ts=1_500_000_000),
+        ],
+        "--type", "shipment.paid", "--since", "2020-01-01T00:00:00", "--rate", "1000",
+    )
+
+    channel.basic_get.assert_called_with(queue="orders.dlq", auto_ack=False)
+    published = [c.kwargs for c in channel.basic_publish.call_args_list]
+    assert published[0]["routing_key"] == "orders"
+    assert "x-attempts" not in published[0]["properties"].headers
+    assert published[0]["properties"].headers["x-replayed"] == 1
+    # Non-matching messages go to the back of the DLQ instead of staying unacked
+    assert [p["routing_key"] for p in published[1:]] == ["orders.dlq", "orders.dlq"]
+    assert sorted(c.kwargs["delivery_tag"] for c in channel.basic_ack.call_args_list) == [1, 2, 3]
+    channel.basic_nack.assert_not_called()
+    channel.tx_commit.assert_called_once()
+    assert "Replayed 1 messages from orders.dlq (3 scanned, 2 not matching)" in output
+
+
+def test_replay_publishes_and_acks_in_batches():
+    channel, output = run(
+        [dead_letter(tag, "shipment.paid", "deadlock") for tag in range(1, 6)],
+        "--batch-size", "2", "--rate", "1000",
+    )
+
+    channel.tx_select.assert_called_once()
+    assert channel.tx_commit.call_count == 3  # 2 + 2 + 1
+    # Each commit follows its batch's publishes and acks
+    calls = [name for name, _, _ in channel.mock_calls if name in ("basic_publish", "basic_ack", "tx_commit")]
+    assert calls[:5] == ["basic_publish", "basic_publish", "basic_ack", "basic_ack", "tx_commit"]
+    assert "Replayed 5 messages" in output
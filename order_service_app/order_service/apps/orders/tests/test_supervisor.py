@@ -0,0 +1,36 @@
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+from ecommerce_messaging.supervisor import Supervisor
+
+
+def exited(exitcode):
+    return SimpleNamespace(is_alive=lambda: False, join=MagicMock(), exitcode=exitcode)
+
+
+def reap(supervisor, process, now=100.0):
+    supervisor._procs[0] = (process, now - 1)
+    with patch("ecommerce_messaging.supervisor.time.monotonic", return_value=now), \
+            patch.object(supervisor, "_spawn") as spawn:
+        supervisor._reap()
+    return spawn
+
+
+def test_crashed_worker_is_restarted_with_backoff():
+    supervisor = Supervisor(MagicMock(), workers=1)
+    supervisor._failures[0] = 2
+
+    spawn = reap(supervisor, exited(1))
+
+    assert supervisor._failures[0] == 3
+    assert supervisor._restart_at == {0: 104.0}
+    spawn.assert_not_called()
+
+
+def test_clean_exit_is_restarted_right_away_without_counting_a_failure():
+    supervisor = Supervisor(MagicMock(), workers=1)
+    supervisor._failures[0] = 2
+
+    spawn = reap(supervisor, exited(0))
+
+    assert supervisor._failures[0] == 2
+    spawn.assert_called_once_with(0)
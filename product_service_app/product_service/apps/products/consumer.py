@@ -1,9 +1,9 @@
 import os
 import sys
-import json
+import asyncio
 import logging
 import django
-import pika
+from collections import defaultdict
 from tenacity import retry, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 
@@ -18,7 +18,16 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "product_service.settings")
 # Initialize Django
 django.setup()
 
-from apps.products.models import Product
+from datetime import timedelta
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from apps.products.models import Product, ProcessedEvent
+from ecommerce_messaging.messaging import BatchConsumer, connect, declare_queue, migrate_queue
+from ecommerce_messaging.supervisor import Supervisor
+from ecommerce_messaging.async_consumer import AsyncConsumer
+from ecommerce_messaging.dedup import EventDeduplicator
+from ecommerce_messaging.metrics import ConsumerMetrics, serve_metrics
+from ecommerce_messaging.flow import PrefetchController
 
 # ------------------------
 # Logging
@@ -32,77 +41,191 @@ logger = logging.getLogger(__name__)
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
 RABBITMQ_PASS = os.getenv("RABBITMQ_PASSWORD", "guest")
-RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE", "shipping_events")
+RABBITMQ_EXCHANGE = os.getenv("RABBITMQ_EXCHANGE", "shipping_events")
+
+# Queue owned by this service, bound only to the event types it handles
+RABBITMQ_QUEUE = os.getenv("CONSUMER_QUEUE", "product_service.shipping_events.v2")
+# Queue this one replaced (declared without x-max-priority); drained into it
+# and deleted by the first worker on start. Empty to skip.
+CONSUMER_LEGACY_QUEUE = os.getenv("CONSUMER_LEGACY_QUEUE", "product_service.shipping_events")
+
+# Batching: up to N messages (also the prefetch window) or T milliseconds
+CONSUMER_BATCH_SIZE = int(os.getenv("CONSUMER_BATCH_SIZE", 100))
+CONSUMER_BATCH_WAIT_MS = int(os.getenv("CONSUMER_BATCH_WAIT_MS", 200))
+
+# Consumer engine: "batch" (blocking, batched UPDATEs) or "asyncio"
+# (one task per message, up to CONSUMER_CONCURRENCY in flight, ORM calls on
+# a pool of CONSUMER_DB_THREADS threads)
+CONSUMER_ENGINE = os.getenv("CONSUMER_ENGINE", "batch")
+CONSUMER_CONCURRENCY = int(os.getenv("CONSUMER_CONCURRENCY", 64))
+CONSUMER_DB_THREADS = int(os.getenv("CONSUMER_DB_THREADS", 8))
+
+# De-duplication: ids kept in memory per process, and how long processed
+# event ids are remembered in the database
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", 100000))
+DEDUP_TTL_HOURS = int(os.getenv("DEDUP_TTL_HOURS", 168))
+
+# Delays (seconds) of the retry tiers a failed message goes through before the DLQ
+CONSUMER_RETRY_DELAYS = tuple(int(d) for d in os.getenv("CONSUMER_RETRY_DELAYS", "1,10,60").split(","))
+
+# Prometheus metrics endpoint; worker N of a supervised pool listens on
+# CONSUMER_METRICS_PORT + N. 0 disables it.
+CONSUMER_METRICS_PORT = int(os.getenv("CONSUMER_METRICS_PORT", 9100))
+CONSUMER_QUEUE_DEPTH_INTERVAL = float(os.getenv("CONSUMER_QUEUE_DEPTH_INTERVAL", 15))
+
+# Adaptive prefetch: grow up to the batch size / concurrency while handler
+# latency stays under the target, shrink towards CONSUMER_PREFETCH_MIN above
+# it, and pause consuming above CONSUMER_PAUSE_LATENCY_MS
+CONSUMER_ADAPTIVE_PREFETCH = os.getenv("CONSUMER_ADAPTIVE_PREFETCH", "True").lower() in ("true", "1", "t")
+CONSUMER_PREFETCH_MIN = int(os.getenv("CONSUMER_PREFETCH_MIN", 10))
+CONSUMER_TARGET_LATENCY_MS = int(os.getenv("CONSUMER_TARGET_LATENCY_MS", 250))
+CONSUMER_PAUSE_LATENCY_MS = int(os.getenv("CONSUMER_PAUSE_LATENCY_MS", 2000))
+CONSUMER_PAUSE_SECONDS = float(os.getenv("CONSUMER_PAUSE_SECONDS", 1))
+
+# Number of consumer processes; each has its own DB and broker connections
+# and metrics port, so scale out explicitly
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", 1))
 
 # ------------------------
-# Callback function
+# Batch handler
 # ------------------------
-def callback(ch, method, properties, body):
-    try:
-        message = json.loads(body)
-        event_type = message.get("type") or message.get("event")
-        data = message.get("data") or message.get("payload", {})
+HANDLED_EVENTS = ("shipment.shipped",)
 
-        logger.info(f"📦 Received event: {event_type} | data={data}")
+dedup = EventDeduplicator(ProcessedEvent, cache_size=DEDUP_CACHE_SIZE, ttl=timedelta(hours=DEDUP_TTL_HOURS))
 
-        if event_type == "shipment.shipped":
-            product_id = data.get("product_id")
-            quantity = data.get("quantity", 0)
 
-            if not product_id:
-                logger.warning("⚠️ Missing product_id in message payload, skipping.")
-                return
+def handle_batch(deliveries):
+    """
+    Apply the stock decrements of a whole batch.
 
-            try:
-                product = Product.objects.get(id=product_id)
-                old_qty = product.stock
-                product.stock = max(0, product.stock - quantity)
-                product.save()
-                logger.info(f"✅ Product {product_id} quantity updated: {old_qty} → {product.stock}")
+    Quantities are summed per product and written as one atomic
+    ``stock = GREATEST(stock - qty, 0)`` UPDATE per product inside a single
+    transaction, so concurrent consumer replicas never lose updates.
+    Events that were already applied (redeliveries) are skipped.
+    """
+    with dedup.processing(deliveries) as fresh:
+        apply_stock_decrements(fresh)
 
-            except Product.DoesNotExist:
-                logger.warning(f"⚠️ Product {product_id} not found in DB")
-            except Exception as e:
-                logger.exception(f"❌ Error updating product {product_id}: {e}")
 
-        else:
+def apply_stock_decrements(deliveries):
+    decrements = defaultdict(int)
+    for delivery in deliveries:
+        event_type = delivery.event["type"]
+        data = delivery.event["data"]
+
+        logger.info(f"📦 Received event: {event_type} | data={data}")
+
+        if event_type not in HANDLED_EVENTS:
             logger.info(f"Ignoring event type: {event_type}")
+            continue
 
-    except Exception as e:
-        logger.exception(f"Failed to process message: {body} | Error: {e}")
+        product_id = data.get("product_id")
+        quantity = int(data.get("quantity", 0))
+        if not product_id:
+            logger.warning("⚠️ Missing product_id in message payload, skipping.")
+            continue
 
-    finally:
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        decrements[int(product_id)] += quantity
 
+    if not decrements:
+        return
+
+    for product_id, quantity in sorted(decrements.items()):  # fixed order avoids deadlocks
+        updated = Product.objects.filter(id=product_id).update(
+            stock=Greatest(F("stock") - quantity, Value(0))
+        )
+        if updated:
+            logger.info(f"✅ Product {product_id} stock decremented by {quantity}")
+        else:
+            logger.warning(f"⚠️ Product {product_id} not found in DB")
 
 
 # ------------------------
 # RabbitMQ consumer
 # ------------------------
+metrics = ConsumerMetrics()
+
+
+def flow_control(max_prefetch):
+    if not CONSUMER_ADAPTIVE_PREFETCH:
+        return None
+    return PrefetchController(
+        min(CONSUMER_PREFETCH_MIN, max_prefetch),
+        max_prefetch,
+        target_latency=CONSUMER_TARGET_LATENCY_MS / 1000,
+        pause_latency=CONSUMER_PAUSE_LATENCY_MS / 1000,
+        pause_seconds=CONSUMER_PAUSE_SECONDS,
+    )
+
+
+def migrate_legacy_queue():
+    connection = connect(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS)
+    try:
+        # The replacement must be bound before the legacy queue is unbound
+        declare_queue(connection.channel(), RABBITMQ_QUEUE, RABBITMQ_EXCHANGE, HANDLED_EVENTS, CONSUMER_RETRY_DELAYS)
+        migrate_queue(
+            connection, CONSUMER_LEGACY_QUEUE, RABBITMQ_QUEUE, RABBITMQ_EXCHANGE, HANDLED_EVENTS, CONSUMER_RETRY_DELAYS
+        )
+    finally:
+        connection.close()
+
+
 @retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=2, min=2, max=30))
 def start_consumer():
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
-    )
+    worker_slot = int(os.getenv("CONSUMER_WORKER_SLOT", 0))
+    if CONSUMER_METRICS_PORT:
+        serve_metrics(metrics, CONSUMER_METRICS_PORT + worker_slot)
+    if CONSUMER_LEGACY_QUEUE and worker_slot == 0:
+        migrate_legacy_queue()
+
+    if CONSUMER_ENGINE == "asyncio":
+        asyncio.run(AsyncConsumer(
+            RABBITMQ_HOST,
+            RABBITMQ_USER,
+            RABBITMQ_PASS,
+            RABBITMQ_QUEUE,
+            RABBITMQ_EXCHANGE,
+            HANDLED_EVENTS,
+            handle_batch,
+            concurrency=CONSUMER_CONCURRENCY,
+            db_threads=CONSUMER_DB_THREADS,
+            retry_delays=CONSUMER_RETRY_DELAYS,
+            metrics=metrics,
+            depth_interval=CONSUMER_QUEUE_DEPTH_INTERVAL,
+            flow=flow_control(CONSUMER_CONCURRENCY),
+        ).run())
+        return
+
+    connection = connect(RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS)
     channel = connection.channel()
 
-    # Dead-letter queue setup
-    dlq_name = f"{RABBITMQ_QUEUE}.dlq"
-    channel.queue_declare(queue=dlq_name, durable=True)
-    args = {"x-dead-letter-exchange": "", "x-dead-letter-routing-key": dlq_name}
+    # Main queue with dead-letter queue setup
+    declare_queue(channel, RABBITMQ_QUEUE, RABBITMQ_EXCHANGE, HANDLED_EVENTS, CONSUMER_RETRY_DELAYS)
 
-    # Main queue
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True, arguments=args)
-
-    logger.info(f"🚀 Listening to RabbitMQ queue: {RABBITMQ_QUEUE}")
+    logger.info(
+        f"🚀 Listening to RabbitMQ queue: {RABBITMQ_QUEUE} "
+        f"(batch_size={CONSUMER_BATCH_SIZE}, max_wait={CONSUMER_BATCH_WAIT_MS}ms)"
+    )
 
-    channel.basic_consume(queue=RABBITMQ_QUEUE, on_message_callback=callback)
-    channel.start_consuming()
+    BatchConsumer(
+        channel,
+        RABBITMQ_QUEUE,
+        handle_batch,
+        batch_size=CONSUMER_BATCH_SIZE,
+        max_wait=CONSUMER_BATCH_WAIT_MS / 1000,
+        retry_delays=CONSUMER_RETRY_DELAYS,
+        metrics=metrics,
+        depth_interval=CONSUMER_QUEUE_DEPTH_INTERVAL,
+        flow=flow_control(CONSUMER_BATCH_SIZE),
+    ).run()
+    connection.close()
 
 
 # ------------------------
 # Main entry
 # ------------------------
 if __name__ == "__main__":
-    start_consumer()
+    if CONSUMER_WORKERS > 1:
+        Supervisor(start_consumer, CONSUMER_WORKERS).run()
+    else:
+        start_consumer()
@@ -0,0 +1,170 @@
+# apps/products/management/commands/replay_dlq.py
+import os, time
+from collections import Counter
+from datetime import datetime, timezone
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from ecommerce_messaging.messaging import ATTEMPTS_HEADER, ERROR_HEADER, connect, to_delivery
+
+DEFAULT_QUEUE = os.getenv("CONSUMER_QUEUE", "product_service.shipping_events.v2")
+
+
+def _parse_time(value):
+    moment = parse_datetime(value)
+    if moment is None:
+        raise CommandError(f"Invalid datetime: {value!r} (expected ISO 8601)")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment
+
+
+def _describe(delivery):
+    """Return (event type, error, event time) of a dead-lettered message."""
+    headers = getattr(delivery.properties, "headers", None) or {}
+    error = headers.get(ERROR_HEADER)
+    if error is None and headers.get("x-death"):
+        error = f"x-death: {headers['x-death'][0].get('reason')}"
+
+    if delivery.event is None:
+        return "<undecodable>", error or "undecodable message", None
+
+    ts = delivery.event.get("ts") or getattr(delivery.properties, "timestamp", None)
+    moment = datetime.fromtimestamp(ts, tz=timezone.utc) if ts else None
+    return delivery.event["type"], error or "unknown", moment
+
+
+class Command(BaseCommand):
+    help = (
+        "Inspect the consumer's dead letter queue and republish matching messages "
+        "to the main queue in rate-limited batches. Each batch is published and "
+        "acked in one AMQP transaction, so a message leaves the DLQ exactly when "
+        "its copy is on the main queue. Messages that do not match are moved to "
+        "the back of the DLQ in the same transaction instead of being held unacked."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue", default=DEFAULT_QUEUE,
+                            help="Main queue; messages are read from <queue>.dlq.")
+        parser.add_argument("--type", action="append", dest="types", default=[],
+                            help="Only replay this event type (repeatable).")
+        parser.add_argument("--since", type=_parse_time, help="Only events at or after this time.")
+        parser.add_argument("--until", type=_parse_time, help="Only events before this time.")
+        parser.add_argument("--rate", type=float, default=50.0,
+                            help="Maximum messages republished per second.")
+        parser.add_argument("--batch-size", type=int, default=100,
+                            help="Republish and ack this many messages per transaction.")
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Stop after republishing this many messages.")
+        parser.add_argument("--dry-run", action="store_true",
+                            help="Only summarize matching messages; leave the DLQ untouched.")
+        parser.add_argument("--peek", type=int, default=1000,
+                            help="Dry run: summarize at most this many messages from the head of the DLQ.")
+
+    def matches(self, event_type, moment, options):
+        if options["types"] and event_type not in options["types"]:
+            return False
+        if options["since"] and (moment is None or moment < options["since"]):
+            return False
+        if options["until"] and (moment is None or moment >= options["until"]):
+            return False
+        return True
+
+    def handle(self, *args, **options):
+        queue = options["queue"]
+        dlq_name = f"{queue}.dlq"
+        dry_run = options["dry_run"]
+        if options["rate"] <= 0:
+            raise CommandError("--rate must be positive")
+        if options["batch_size"] <= 0:
+            raise CommandError("--batch-size must be positive")
+        if options["peek"] <= 0:
+            raise CommandError("--peek must be positive")
+
+        connection = connect(os.getenv("RABBITMQ_HOST"), os.getenv("RABBITMQ_USER"), os.getenv("RABBITMQ_PASSWORD"))
+        channel = connection.channel()
+        # Only look at what is in the DLQ now, not at messages that fail again while we replay
+        total = channel.queue_declare(queue=dlq_name, passive=True).method.message_count
+        if dry_run:
+            # Peeked messages stay unacked until the end, so only look at a bounded head
+            self.stdout.write(f"{dlq_name}: {total} messages (dry run, peeking at {min(total, options['peek'])})")
+            total = min(total, options["peek"])
+        else:
+            channel.tx_select()
+            self.stdout.write(f"{dlq_name}: {total} messages")
+
+        summary = Counter()
+        scanned = replayed = skipped = 0
+        batch = []  # delivery tags republished in the open transaction
+        parked = []  # delivery tags of non-matching messages moved to the back of the DLQ
+        last_tag = None
+        started = time.monotonic()
+
+        def commit():
+            nonlocal replayed
+            # Publishes and acks of the batch become visible together
+            for tag in batch + parked:
+                channel.basic_ack(delivery_tag=tag)
+            channel.tx_commit()
+            replayed += len(batch)
+            batch.clear()
+            parked.clear()
+            self.stdout.write(f"  replayed {replayed} (scanned {scanned}/{total})")
+
+            # Rate limit: never get ahead of replayed / rate seconds
+            ahead = replayed / options["rate"] - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+        try:
+            while scanned < total:
+                if options["limit"] is not None and replayed + len(batch) >= options["limit"]:
+                    break
+                method, properties, body = channel.basic_get(queue=dlq_name, auto_ack=False)
+                if method is None:
+                    break
+                scanned += 1
+                last_tag = method.delivery_tag
+
+                delivery = to_delivery(method, properties, body)
+                event_type, error, moment = _describe(delivery)
+                if not self.matches(event_type, moment, options):
+                    skipped += 1
+                    if not dry_run:
+                        # A requeued message would come straight back to the head of
+                        # the DLQ; move it behind the messages still to be scanned
+                        channel.basic_publish(exchange="", routing_key=dlq_name, body=body, properties=properties)
+                        parked.append(method.delivery_tag)
+                        if len(batch) + len(parked) >= options["batch_size"]:
+                            commit()
+                    continue
+                summary[(event_type, error)] += 1
+                if dry_run:
+                    continue
+
+                # Give the replayed message a fresh set of retries
+                headers = dict(properties.headers or {})
+                headers.pop(ATTEMPTS_HEADER, None)
+                headers["x-replayed"] = int(headers.get("x-replayed", 0)) + 1
+                properties.headers = headers
+                channel.basic_publish(exchange="", routing_key=queue, body=body, properties=properties)
+                batch.append(method.delivery_tag)
+                if len(batch) + len(parked) >= options["batch_size"]:
+                    commit()
+            if dry_run and last_tag is not None:
+                channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            elif batch or parked:
+                commit()
+        finally:
+            # Anything still unacked (an uncommitted batch whose publishes are
+            # rolled back) returns to the DLQ
+            connection.close()
+
+        self.stdout.write("Matching messages by event type and error:")
+        for (event_type, error), count in summary.most_common():
+            self.stdout.write(f"  {count:>7}  {event_type}  {error}")
+
+        verb = "Would replay" if dry_run else "Replayed"
+        self.stdout.write(self.style.SUCCESS(
+            f"{verb} {sum(summary.values()) if dry_run else replayed} messages "
+            f"from {dlq_name} ({scanned} scanned, {skipped} not matching)."
+        ))
@@ -9,3 +9,16 @@ class Product(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class ProcessedEvent(models.Model):
+    """Id of an event the consumer has already applied (see ecommerce_messaging.dedup)."""
+    event_id = models.CharField(max_length=64, unique=True)
+    event_type = models.CharField(max_length=50)
+    processed_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.event_type} {self.event_id}"
+
+    class Meta:
+        db_table = "processed_events"
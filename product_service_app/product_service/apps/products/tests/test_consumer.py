@@ -0,0 +1,87 @@
+import re
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from apps.products.consumer import handle_batch
+from ecommerce_messaging.envelope import build_envelope
+from ecommerce_messaging.messaging import Delivery
+from apps.products.models import Product
+
+
+def delivery(tag, event_type, **data):
+    return Delivery(tag, False, None, b"", build_envelope(event_type, data))
+
+
+def make_product(stock):
+    return Product.objects.create(name="Widget", description="", price=1, stock=stock)
+
+
+def updated_ids(queries):
+    return [
+        int(re.search(r'"id" = (\d+)', q["sql"]).group(1))
+        for q in queries if q["sql"].startswith("UPDATE")
+    ]
+
+
+@pytest.mark.django_db
+def test_handle_batch_sums_repeated_products_into_one_update(django_assert_num_queries):
+    product = make_product(stock=10)
+
+    with django_assert_num_queries(5):  # SAVEPOINT + dedup SELECT + UPDATE + dedup INSERT + RELEASE
+        handle_batch([
+            delivery(1, "shipment.shipped", product_id=product.id, quantity=2),
+            delivery(2, "shipment.shipped", product_id=product.id, quantity=3),
+        ])
+
+    product.refresh_from_db()
+    assert product.stock == 5
+
+
+@pytest.mark.django_db
+def test_handle_batch_clamps_stock_at_zero():
+    product = make_product(stock=2)
+
+    handle_batch([delivery(1, "shipment.shipped", product_id=product.id, quantity=5)])
+
+    product.refresh_from_db()
+    assert product.stock == 0
+
+
+@pytest.mark.django_db
+def test_handle_batch_updates_products_in_id_order():
+    low, high = make_product(stock=10), make_product(stock=10)
+
+    with CaptureQueriesContext(connection) as queries:
+        handle_batch([
+            delivery(1, "shipment.shipped", product_id=high.id, quantity=1),
+            delivery(2, "shipment.shipped", product_id=low.id, quantity=1),
+        ])
+
+    # Every replica locks rows in the same order, so batches cannot deadlock
+    assert updated_ids(queries.captured_queries) == [low.id, high.id]
+
+
+@pytest.mark.django_db
+def test_handle_batch_ignores_other_events_and_missing_products():
+    product = make_product(stock=10)
+
+    handle_batch([
+        delivery(1, "shipment.paid", product_id=product.id, quantity=1),
+        delivery(2, "shipment.shipped", product_id=product.id + 100, quantity=1),
+        delivery(3, "shipment.shipped", quantity=1),
+    ])
+
+    product.refresh_from_db()
+    assert product.stock == 10
+
+
+@pytest.mark.django_db
+def test_redelivered_event_is_applied_once():
+    product = make_product(stock=10)
+    shipped = delivery(1, "shipment.shipped", product_id=product.id, quantity=4)
+
+    handle_batch([shipped])
+    handle_batch([shipped._replace(delivery_tag=2, redelivered=True)])
+
+    product.refresh_from_db()
+    assert product.stock == 6
@@ -0,0 +1,120 @@
+# apps/shipping/cache_metrics.py
+import os
+import hmac
+import bisect
+import threading
+from collections import defaultdict
+from django.http import Http404, HttpResponse
+from .dispatcher import render_metrics as render_dispatcher_metrics
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Bearer token Prometheus must send to scrape /metrics; unset hides the endpoint
+METRICS_TOKEN = os.getenv("SHIPPING_METRICS_TOKEN", "")
+
+class Histogram:
+    """Fixed-bucket histogram; not thread-safe on its own, guarded by CacheMetrics"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            le = bound if bound == "+Inf" else repr(float(bound))
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+class CacheMetrics:
+    """
+    Thread-safe shipment cache instrumentation, per cache prefix.
+
+    Counts hits (by tier), misses, early refreshes and invalidations, and
+    keeps histograms of fill latency (query + serialization on a miss),
+    stored payload size and Redis call latency (per operation). ``render``
+    returns the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = defaultdict(int)  # (prefix, tier) -> count
+        self.misses = defaultdict(int)
+        self.refreshes = defaultdict(int)
+        self.invalidations = defaultdict(int)
+        self.fill_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))
+        self.payload_bytes = defaultdict(lambda: Histogram(SIZE_BUCKETS))
+        self.redis_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # operation -> histogram
+
+    def record_hit(self, prefix, tier):
+        with self._lock:
+            self.hits[(prefix, tier)] += 1
+
+    def record_miss(self, prefix):
+        with self._lock:
+            self.misses[prefix] += 1
+
+    def record_refresh(self, prefix):
+        with self._lock:
+            self.refreshes[prefix] += 1
+
+    def record_invalidation(self, prefix):
+        with self._lock:
+            self.invalidations[prefix] += 1
+
+    def observe_fill(self, prefix, seconds, size):
+        with self._lock:
+            self.fill_latency[prefix].observe(seconds)
+            self.payload_bytes[prefix].observe(size)
+
+    def observe_redis(self, operation, seconds):
+        with self._lock:
+            self.redis_latency[operation].observe(seconds)
+
+    def render(self):
+        with self._lock:
+            lines = ["# HELP shipping_cache_hits_total Cache hits, by prefix and tier.",
+                     "# TYPE shipping_cache_hits_total counter"]
+            lines += [f'shipping_cache_hits_total{{prefix="{p}",tier="{t}"}} {v}'
+                      for (p, t), v in sorted(self.hits.items())]
+            for name, help_text, values in (
+                ("shipping_cache_misses_total", "Cache misses, by prefix.", self.misses),
+                ("shipping_cache_early_refreshes_total", "Entries recomputed before expiry, by prefix.", self.refreshes),
+                ("shipping_cache_invalidations_total", "Namespace generation bumps, by prefix.", self.invalidations),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+                lines += [f'{name}{{prefix="{p}"}} {v}' for p, v in sorted(values.items())]
+
+            for name, help_text, label, histograms in (
+                ("shipping_cache_fill_seconds", "Time to compute a cache entry on a miss.", "prefix", self.fill_latency),
+                ("shipping_cache_payload_bytes", "Size of stored cache entries.", "prefix", self.payload_bytes),
+                ("shipping_cache_redis_seconds", "Redis call latency, by operation.", "operation", self.redis_latency),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, histogram in sorted(histograms.items()):
+                    lines += histogram.render(name, f'{label}="{key}"')
+            return "\n".join(lines) + "\n"
+
+cache_metrics = CacheMetrics()
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for this process's cache and event dispatcher metrics"""
+    if not METRICS_TOKEN:
+        raise Http404()
+    if not hmac.compare_digest(request.META.get("HTTP_AUTHORIZATION", ""), f"Bearer {METRICS_TOKEN}"):
+        response = HttpResponse("Unauthorized\n", status=401, content_type="text/plain")
+        response["WWW-Authenticate"] = 'Bearer realm="metrics"'
+        return response
+    body = cache_metrics.render() + render_dispatcher_metrics()
+    return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,35 +1,382 @@
 # apps/shipping/cache_utils.py
+import os
+import math
+import time
+import uuid
+import pickle
+import random
 import hashlib
 import logging
+import threading
+import zlib
+from collections import OrderedDict
 from django.core.cache import cache
-from rest_framework.response import Response
+from django.http import HttpResponse, HttpResponseNotModified
+from django_redis import get_redis_connection
+from rest_framework.renderers import JSONRenderer
+from .cache_metrics import cache_metrics
+
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover - lz4 is optional
+    lz4 = None
 
 logger = logging.getLogger(__name__)
 
+CACHE_TIMEOUT = int(os.getenv("SHIPPING_CACHE_TIMEOUT", 60))
+# Bodies of at least COMPRESS_MIN_BYTES are stored compressed in Redis with
+# SHIPPING_CACHE_COMPRESSION: lz4 (default when installed), zlib or none
+COMPRESS_MIN_BYTES = int(os.getenv("SHIPPING_CACHE_COMPRESS_MIN_BYTES", 16 * 1024))
+COMPRESSION = os.getenv("SHIPPING_CACHE_COMPRESSION", "lz4" if lz4 else "zlib").lower()
+if COMPRESSION == "lz4" and lz4 is None:
+    logger.warning("[CACHE] lz4 is not installed, compressing with zlib")
+    COMPRESSION = "zlib"
+
+# Add a Server-Timing header describing the cache lookup/fill to cached list responses
+SERVER_TIMING = os.getenv("SHIPPING_CACHE_SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+# In-process tier in front of Redis (0 bytes disables it). Generations are
+# only trusted locally for LOCAL_GENERATION_TTL seconds in case a pub/sub
+# invalidation is missed.
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("SHIPPING_LOCAL_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+LOCAL_GENERATION_TTL = float(os.getenv("SHIPPING_LOCAL_GENERATION_TTL", 5))
+INVALIDATION_CHANNEL = "shipping_cache_invalidation"
+
+# Single-flight fills: one request per key recomputes under a short Redis
+# lease while the others poll for its result. XFETCH_BETA > 1 refreshes
+# hot keys earlier, 0 disables early refresh.
+FILL_LOCK_LEASE = float(os.getenv("SHIPPING_CACHE_FILL_LEASE", 5))
+FILL_WAIT = float(os.getenv("SHIPPING_CACHE_FILL_WAIT", 2))
+FILL_POLL_INTERVAL = float(os.getenv("SHIPPING_CACHE_FILL_POLL_INTERVAL", 0.05))
+XFETCH_BETA = float(os.getenv("SHIPPING_CACHE_XFETCH_BETA", 1))
+
+# Deletes the fill lease only while it still holds our token: once it has
+# expired another request may own it, and a plain GET + DEL could drop theirs
+RELEASE_FILL_LOCK = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+class LocalCache:
+    """Thread-safe in-process LRU with per-entry TTL, bounded by approximate pickled size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, value, size)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._pop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, timeout):
+        if not self.max_bytes:
+            return
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) + len(key)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (time.monotonic() + timeout, value, size)
+            self._size += size
+            while self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _pop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+local_cache = LocalCache(LOCAL_CACHE_MAX_BYTES)
+
+def _redis(operation, call, *args, **kwargs):
+    """Run one cache/Redis call, recording its latency under ``operation``"""
+    started = time.perf_counter()
+    try:
+        return call(*args, **kwargs)
+    finally:
+        cache_metrics.observe_redis(operation, time.perf_counter() - started)
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+def _listen_for_invalidations():
+    """Evict local generations other workers bumped; reconnects forever"""
+    while True:
+        try:
+            pubsub = get_redis_connection("default").pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            # Anything published while we were not subscribed is lost
+            local_cache.clear()
+            for message in pubsub.listen():
+                local_cache.delete(message["data"].decode())
+        except Exception as e:
+            logger.warning(f"[CACHE] invalidation listener lost Redis ({e}), reconnecting")
+            local_cache.clear()
+            time.sleep(1)
+
+def start_invalidation_listener():
+    """Start this process's pub/sub listener unless it is running (or the local tier is off)"""
+    global _listener, _listener_pid
+    if not LOCAL_CACHE_MAX_BYTES or (_listener_pid == os.getpid() and _listener.is_alive()):
+        return
+    with _listener_lock:
+        if _listener_pid != os.getpid() or not _listener.is_alive():
+            _listener = threading.Thread(
+                target=_listen_for_invalidations, name="shipping-cache-invalidation", daemon=True
+            )
+            _listener.start()
+            _listener_pid = os.getpid()
+
+# Prefixes whose entries only depend on the requesting user's own shipments:
+# they get one generation per user, so a write only invalidates its owner
+USER_SCOPED_PREFIXES = {"my_shipments"}
+
+def get_generation_key(prefix: str, user_id=None):
+    if user_id is None:
+        return f"{prefix}_generation"
+    return f"{prefix}_{user_id}_generation"
+
+def _generation_pipeline(key):
+    """
+    MULTI pipeline that first (re)creates a missing generation key.
+
+    Generations start at the current time in nanoseconds rather than 0: a
+    key evicted under maxmemory comes back far past every generation its
+    still-cached entries were built with, so none of them is served again.
+    """
+    redis_key = cache.make_key(key)
+    pipe = get_redis_connection("default").pipeline()
+    pipe.set(redis_key, time.time_ns(), nx=True)
+    return pipe, redis_key
+
+def get_generation(prefix: str, user_id=None):
+    """Current generation of a cache namespace (created on first use)"""
+    key = get_generation_key(prefix, user_id)
+    generation = local_cache.get(key)
+    if generation is None:
+        start_invalidation_listener()
+        pipe, redis_key = _generation_pipeline(key)
+        pipe.get(redis_key)
+        generation = int(_redis("get_or_set", pipe.execute)[1])
+        local_cache.set(key, generation, LOCAL_GENERATION_TTL)
+    return generation
+
 def get_cache_key(prefix: str, request):
-    """Generate a unique cache key based on user + URL + query params"""
+    """Generate a unique cache key based on user + URL + query params + namespace generation"""
     user_id = getattr(request.user, "id", "anon")
+    scope = user_id if prefix in USER_SCOPED_PREFIXES else None
     path = request.get_full_path()
-    hash_key = hashlib.md5(path.encode()).hexdigest()
+    hash_key = hashlib.md5(f"{get_generation(prefix, scope)}:{path}".encode()).hexdigest()
     return f"{prefix}_{user_id}_{hash_key}"
 
+class CachedResponse(HttpResponse):
+    """Pre-rendered JSON list response, sent as stored"""
+
+    def __init__(self, body, etag):
+        super().__init__(body, content_type="application/json")
+        self["ETag"] = etag
+        # Entries are per user: only the client may keep them, and it must revalidate
+        self["Cache-Control"] = "private, no-cache"
+
+def _etag_matches(request, etag):
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
+
+def _respond(request, entry, timing):
+    """304 if the client already has this entry, else its stored bytes"""
+    if _etag_matches(request, entry["etag"]):
+        response = HttpResponseNotModified()
+        response["ETag"] = entry["etag"]
+    else:
+        response = CachedResponse(entry["body"], entry["etag"])
+    if SERVER_TIMING:
+        response["Server-Timing"] = timing
+    return response
+
+def _compress(body):
+    """Return (stored bytes, encoding tag) for a rendered body"""
+    if len(body) < COMPRESS_MIN_BYTES or COMPRESSION == "none":
+        return body, "identity"
+    if COMPRESSION == "lz4":
+        return lz4.frame.compress(body), "lz4"
+    return zlib.compress(body), "zlib"
+
+def _decompress(stored, encoding):
+    if encoding == "lz4":
+        return lz4.frame.decompress(stored)
+    if encoding == "zlib":
+        return zlib.decompress(stored)
+    return stored
+
+def _pack(entry):
+    """Redis form of an entry: the body compressed and tagged with its encoding"""
+    body, encoding = _compress(entry["body"])
+    return {**entry, "body": body, "encoding": encoding}
+
+def _unpack(stored):
+    """Entry as served: the body decompressed according to its encoding tag"""
+    entry = dict(stored)
+    entry["body"] = _decompress(entry["body"], entry.pop("encoding", "identity"))
+    return entry
+
+def _get_entry(cache_key):
+    """Cached entry from the local tier, else from Redis (filling the local tier); returns (entry, tier)"""
+    entry = local_cache.get(cache_key)
+    if entry is not None:
+        return entry, "local"
+    stored = _redis("get", cache.get, cache_key)
+    if stored is not None:
+        # The local tier keeps bodies decompressed so local hits cost no CPU
+        entry = _unpack(stored)
+        local_cache.set(cache_key, entry, entry["expiry"] - time.time())
+        return entry, "redis"
+    return None, None
+
+def _should_refresh_early(entry):
+    """XFetch: recompute before expiry with a probability rising as expiry nears and with the fill cost"""
+    if not XFETCH_BETA or entry["delta"] is None:
+        return False
+    return time.time() - entry["delta"] * XFETCH_BETA * math.log(1 - random.random()) >= entry["expiry"]
+
+def _start_fill(request, prefix, cache_key, token=None):
+    """Remember the key and start time of the query set_cached_response will store"""
+    request._cache_fills = getattr(request, "_cache_fills", {})
+    request._cache_fills[prefix] = (cache_key, token, time.monotonic())
+
+def _acquire_fill_lock(request, prefix, cache_key):
+    """Take the fill lease for cache_key; set_cached_response releases it"""
+    token = uuid.uuid4().hex
+    lock_key = cache.make_key(f"{cache_key}_lock")
+    client = get_redis_connection("default")
+    if not _redis("add", client.set, lock_key, token, nx=True, px=int(FILL_LOCK_LEASE * 1000)):
+        return False
+    _start_fill(request, prefix, cache_key, token)
+    return True
+
+def _release_fill_lock(cache_key, token):
+    lock_key = cache.make_key(f"{cache_key}_lock")
+    release = get_redis_connection("default").register_script(RELEASE_FILL_LOCK)
+    _redis("delete", release, keys=[lock_key], args=[token])
+
+def _timing(description, started):
+    return f'cache;desc="{description}";dur={(time.perf_counter() - started) * 1000:.1f}'
+
 def get_cached_response(prefix: str, request):
-    """Try to get cached response"""
+    """
+    Try to get cached response, from the local tier first, then Redis.
+
+    On a miss only the request holding the fill lock recomputes (returns
+    None); the others wait up to FILL_WAIT for its result and recompute
+    themselves only if it never comes. Entries close to expiry are
+    refreshed early by a single request while everyone else is still
+    served the current one.
+    """
+    started = time.perf_counter()
     cache_key = get_cache_key(prefix, request)
-    cached_data = cache.get(cache_key)
-    if cached_data:
-        logger.info(f"[CACHE HIT] key={cache_key}")
-        return Response(cached_data)
+    entry, tier = _get_entry(cache_key)
+    if entry is not None:
+        if _should_refresh_early(entry) and _acquire_fill_lock(request, prefix, cache_key):
+            cache_metrics.record_refresh(prefix)
+            logger.info(f"[CACHE REFRESH] key={cache_key}")
+            return None
+        cache_metrics.record_hit(prefix, tier)
+        logger.info(f"[CACHE HIT] key={cache_key} tier={tier}")
+        return _respond(request, entry, _timing(f"hit-{tier}", started))
+
+    if _acquire_fill_lock(request, prefix, cache_key):
+        cache_metrics.record_miss(prefix)
+        return None
+
+    deadline = time.monotonic() + FILL_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(FILL_POLL_INTERVAL)
+        entry, tier = _get_entry(cache_key)
+        if entry is not None:
+            cache_metrics.record_hit(prefix, "wait")
+            logger.info(f"[CACHE HIT] key={cache_key} tier={tier} waited=1")
+            return _respond(request, entry, _timing("hit-wait", started))
+    cache_metrics.record_miss(prefix)
+    logger.warning(f"[CACHE] gave up waiting for fill of key={cache_key}")
+    _start_fill(request, prefix, cache_key)
     return None
 
-def set_cached_response(prefix: str, request, data, timeout=60):
-    """Save serialized response data to cache"""
-    cache_key = get_cache_key(prefix, request)
-    cache.set(cache_key, data, timeout=timeout)
+def set_cached_response(prefix: str, request, data, timeout=None):
+    """
+    Render serialized response data once, cache the bytes with their ETag
+    and release the fill lock taken by get_cached_response. Returns the
+    response to send (304 if the client already has these bytes).
+    """
+    # Keep the key read before the query: if a write bumped the generation
+    # meanwhile, this possibly stale result must not land in the new one
+    fill = getattr(request, "_cache_fills", {}).pop(prefix, None)
+    cache_key, token, started = fill or (get_cache_key(prefix, request), None, None)
+    timeout = timeout or CACHE_TIMEOUT
+    body = JSONRenderer().render(data)
+    # Without a recorded fill the query cost is unknown: the entry is stored
+    # without it and never refreshed early
+    delta = None if started is None else time.monotonic() - started
+    entry = {
+        "body": body,
+        "etag": f'"{hashlib.md5(body).hexdigest()}"',
+        "delta": delta,
+        "expiry": time.time() + timeout,
+    }
+    stored = _pack(entry)
+    if delta is not None:
+        cache_metrics.observe_fill(prefix, delta, len(stored["body"]))
+    _redis("set", cache.set, cache_key, stored, timeout=timeout)
+    local_cache.set(cache_key, entry, timeout)
+    if token is not None:
+        _release_fill_lock(cache_key, token)
     logger.info(f"[CACHE SET] key={cache_key}")
+    timing = 'cache;desc="miss"' if delta is None else f'cache;desc="miss", fill;dur={delta * 1000:.1f}'
+    return _respond(request, entry, timing)
+
+def invalidate_cache(prefix: str, user_id=None):
+    """
+    Invalidate every cache entry of a prefix, or of one user for user-scoped prefixes.
+
+    Bumps the namespace generation with a single atomic INCR (one round
+    trip, together with re-creating an evicted key) instead of scanning
+    the keyspace: keys built afterwards hash a new generation, and entries
+    of the old one are never read again and simply expire.
+    """
+    key = get_generation_key(prefix, user_id)
+    pipe, redis_key = _generation_pipeline(key)
+    pipe.incr(redis_key)
+    generation = _redis("incr", pipe.execute)[1]
+    # Evict our own copy right away, and every other worker's via pub/sub
+    local_cache.delete(key)
+    _redis("publish", get_redis_connection("default").publish, INVALIDATION_CHANNEL, key)
+    cache_metrics.record_invalidation(prefix)
+    logger.info(f"[CACHE INVALIDATED] prefix={prefix} user={user_id} generation={generation}")
 
-def invalidate_cache_patterns(patterns):
-    """Delete all cache entries matching certain prefixes"""
-    for pattern in patterns:
-        cache.delete_pattern(f"{pattern}_*")
-        logger.info(f"[CACHE INVALIDATED] pattern={pattern}_*")
+def invalidate_shipment_caches(*user_ids):
+    """Invalidate all_shipments and the my_shipments entries of the given shipment owners"""
+    invalidate_cache("all_shipments")
+    for user_id in {u for u in user_ids if u is not None}:
+        invalidate_cache("my_shipments", user_id)
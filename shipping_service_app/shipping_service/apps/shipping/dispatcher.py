@@ -0,0 +1,321 @@
+# apps/shipping/dispatcher.py
+import os, time, queue, atexit, logging, threading
+from django.db import close_old_connections
+from django.utils import timezone
+from rest_framework.exceptions import APIException
+from .models import OutboxEvent
+from . import utils
+from .publisher import ConfirmPublisher, PublishReturned, render_metrics as render_publisher_metrics
+from .spool import SpoolFull
+from .utils import (
+    spool,
+    start_spool_replay,
+    encode_event,
+    RABBITMQ_HOST,
+    RABBITMQ_USER,
+    RABBITMQ_PASS,
+    RABBITMQ_EXCHANGE,
+    RABBITMQ_MAX_IN_FLIGHT,
+)
+
+logger = logging.getLogger(__name__)
+
+# ------------------------
+# In-process publishing config
+# ------------------------
+PUBLISH_IN_PROCESS = os.getenv("SHIPPING_PUBLISH_IN_PROCESS", "True").lower() in ("true", "1", "t")
+PUBLISH_QUEUE_SIZE = int(os.getenv("SHIPPING_PUBLISH_QUEUE_SIZE", 10000))
+PUBLISH_OVERFLOW = os.getenv("SHIPPING_PUBLISH_OVERFLOW", "block")  # block | drop | spool | fail
+PUBLISH_BLOCK_TIMEOUT = float(os.getenv("SHIPPING_PUBLISH_BLOCK_TIMEOUT", 0.5))
+PUBLISH_BATCH_SIZE = int(os.getenv("SHIPPING_PUBLISH_BATCH_SIZE", 200))
+# Seconds to wait for a broker confirm; relay_outbox only takes rows older than this
+PUBLISH_CONFIRM_TIMEOUT = float(os.getenv("SHIPPING_PUBLISH_CONFIRM_TIMEOUT", 30))
+
+OVERFLOW_POLICIES = ("block", "drop", "spool", "fail")
+
+
+class PublishQueueFull(APIException):
+    status_code = 503
+    default_detail = "Shipment event queue is full, try again later."
+    default_code = "publish_queue_full"
+
+
+class DispatcherStats:
+    """Thread-safe counters for the background publish queue."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.published = 0
+        self.dropped = 0
+        self.spooled = 0
+        self.returned = 0
+        self.failed = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def record_published(self, latencies):
+        with self._lock:
+            self.published += len(latencies)
+            self.latency_total += sum(latencies)
+            self.latency_max = max([self.latency_max, *latencies])
+
+    def snapshot(self, depth=0):
+        with self._lock:
+            avg = self.latency_total / self.published if self.published else 0.0
+            return {
+                "queue_depth": depth,
+                "enqueued": self.enqueued,
+                "published": self.published,
+                "dropped": self.dropped,
+                "spooled": self.spooled,
+                "returned": self.returned,
+                "failed": self.failed,
+                "enqueue_to_publish_avg_ms": round(avg * 1000, 3),
+                "enqueue_to_publish_max_ms": round(self.latency_max * 1000, 3),
+            }
+
+    def render(self, depth=0):
+        """Prometheus text exposition of the counters and the current queue depth."""
+        with self._lock:
+            lines = ["# HELP shipping_dispatch_queue_depth Events waiting in the in-process publish queue.",
+                     "# TYPE shipping_dispatch_queue_depth gauge",
+                     f"shipping_dispatch_queue_depth {depth}",
+                     "# HELP shipping_dispatch_events_total Outbox events handled by the dispatcher, by outcome.",
+                     "# TYPE shipping_dispatch_events_total counter"]
+            for outcome in ("enqueued", "published", "dropped", "spooled", "returned", "failed"):
+                lines.append(f'shipping_dispatch_events_total{{outcome="{outcome}"}} {getattr(self, outcome)}')
+            lines += ["# HELP shipping_dispatch_latency_seconds Time from enqueue to broker confirm.",
+                      "# TYPE shipping_dispatch_latency_seconds summary",
+                      f"shipping_dispatch_latency_seconds_sum {self.latency_total}",
+                      f"shipping_dispatch_latency_seconds_count {self.published}",
+                      "# HELP shipping_dispatch_latency_max_seconds Slowest enqueue to confirm so far.",
+                      "# TYPE shipping_dispatch_latency_max_seconds gauge",
+                      f"shipping_dispatch_latency_max_seconds {self.latency_max}"]
+            return "\n".join(lines) + "\n"
+
+
+class BackgroundPublisher:
+    """
+    Bounded in-process queue drained by a dedicated publisher thread.
+
+    Views hand over committed outbox events and return immediately; the
+    thread pipelines them through a confirm-mode publisher and marks the
+    rows sent. While the broker is unreachable, batches go to the local
+    disk spool instead and its replayer publishes them once it is back. Events the broker returns as unroutable (no consumer binds
+    their type) are marked sent as well, since no retry can deliver them.
+    Spooled rows stay pending until the replay's confirm marks them sent:
+    events that never make it (overflow, broker down, spool lost, process
+    killed) stay pending in the outbox and are picked up by relay_outbox.
+
+    Overflow policies when the queue is full:
+      - block: wait up to ``block_timeout`` seconds, then drop
+      - drop:  leave the event to the outbox relay
+      - spool: append it to the local disk spool
+      - fail:  refuse new shipment writes with HTTP 503 (see ``check_capacity``)
+    """
+
+    def __init__(self, publisher_factory, maxsize=10000, overflow="block",
+                 block_timeout=0.5, batch_size=200, retry_after=5.0, confirm_timeout=30.0):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}")
+        self.publisher_factory = publisher_factory
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.retry_after = retry_after
+        self.confirm_timeout = confirm_timeout
+        self.stats = DispatcherStats()
+
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._stopping = threading.Event()
+        self._thread = None
+        self._publisher = None
+        self._broker_down_until = 0.0
+
+    # ------------------------
+    # Producer side (request threads)
+    # ------------------------
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def check_capacity(self):
+        """Raise PublishQueueFull under the ``fail`` policy when the queue is full."""
+        if self.overflow == "fail" and self._queue.full():
+            raise PublishQueueFull()
+
+    def submit(self, event):
+        """Queue a committed OutboxEvent for publishing. Returns False if it was dropped."""
+        item = (event.id, event.event_type, event.payload, event.event_id, time.monotonic())
+        try:
+            if self.overflow == "block":
+                self._queue.put(item, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except queue.Full:
+            if self.overflow == "spool" and self._spool([item]):
+                return False
+            self.stats.incr("dropped")
+            logger.warning(f"[DISPATCH] queue full, event id={event.id} left to outbox relay")
+            return False
+        self.stats.incr("enqueued")
+        return True
+
+    def _spool(self, items):
+        """Append queued items to the disk spool; returns how many made it (in order)."""
+        spooled = 0
+        for item in items:
+            try:
+                body, _ = encode_event(*item[1:4])
+                spool.append(body)
+            except (SpoolFull, OSError) as e:
+                logger.warning(f"[DISPATCH] could not spool event id={item[0]}, left to outbox relay: {e}")
+                break
+            spooled += 1
+        if spooled:
+            self.stats.incr("spooled", spooled)
+            start_spool_replay()
+        return spooled
+
+    # ------------------------
+    # Publisher thread
+    # ------------------------
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="shipping-event-dispatcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            try:
+                batch = [self._queue.get(timeout=0.2)]
+            except queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            close_old_connections()
+            try:
+                self.publish_batch(batch)
+            except Exception as e:
+                self.stats.incr("failed", len(batch))
+                logger.exception(f"[DISPATCH] failed to publish batch of {len(batch)}: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+        if self._publisher is not None:
+            self._publisher.close()
+
+    def publish_batch(self, batch):
+        """
+        Publish queued items, wait for confirms and mark the acked rows sent.
+
+        Like relay_batch, stops at the first unconfirmed event so a later
+        event of the same shipment is never marked sent ahead of it; the
+        rest of the batch stays pending for the relay.
+        """
+        if time.monotonic() < self._broker_down_until:
+            self.stats.incr("failed", len(batch) - self._spool(batch))
+            return
+
+        if self._publisher is None:
+            self._publisher = self.publisher_factory()
+
+        try:
+            confirms = []
+            for item in batch:
+                body, properties = encode_event(*item[1:4])
+                future = self._publisher.publish(body, routing_key=item[1], properties=properties)
+                confirms.append((item, future))
+        except Exception as e:
+            # Could not (re)connect: back off and spool the batch. Whatever
+            # got published before the failure is delivered twice at worst
+            self._broker_down_until = time.monotonic() + self.retry_after
+            logger.warning(f"[DISPATCH] broker unavailable, spooling for {self.retry_after}s: {e}")
+            self.stats.incr("failed", len(batch) - self._spool(batch))
+            return
+
+        sent_ids, latencies = [], []
+        for position, ((event_id, event_type, _, _, enqueued_at), future) in enumerate(confirms):
+            try:
+                future.result(timeout=self.confirm_timeout)
+            except PublishReturned:
+                self.stats.incr("returned")
+                logger.warning(f"[DISPATCH] no consumer for event id={event_id} type={event_type}")
+                sent_ids.append(event_id)
+                continue
+            except Exception as e:
+                self.stats.incr("failed", len(confirms) - position)
+                logger.warning(f"[DISPATCH] event id={event_id} not confirmed, "
+                               f"leaving it and {len(confirms) - position - 1} later events to the relay: {e}")
+                break
+            sent_ids.append(event_id)
+            latencies.append(time.monotonic() - enqueued_at)
+
+        if sent_ids:
+            OutboxEvent.objects.filter(id__in=sent_ids, sent_at__isnull=True).update(sent_at=timezone.now())
+            self.stats.record_published(latencies)
+
+    def stop(self, timeout=10.0):
+        """Flush what is queued and stop the thread."""
+        if not (self._thread and self._thread.is_alive()):
+            return
+        self._stopping.set()
+        self._thread.join(timeout=timeout)
+        if self._thread.is_alive():
+            logger.warning(f"[DISPATCH] shutdown timed out, {self.depth} events left to outbox relay")
+
+
+_dispatcher = None
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+
+
+def render_metrics():
+    """Prometheus text for this process's dispatcher and the publishers it and the spool use."""
+    dispatcher = _dispatcher if _dispatcher_pid == os.getpid() else None
+    publishers = {"spool": utils._publisher}
+    text = ""
+    if dispatcher is not None:
+        publishers["dispatcher"] = dispatcher._publisher
+        text = dispatcher.stats.render(dispatcher.depth)
+    return text + render_publisher_metrics(publishers)
+
+
+def get_dispatcher():
+    """Return the started process-wide dispatcher, or None if in-process publishing is off."""
+    global _dispatcher, _dispatcher_pid
+    if not PUBLISH_IN_PROCESS:
+        return None
+    if _dispatcher is None or _dispatcher_pid != os.getpid():
+        with _dispatcher_lock:
+            if _dispatcher is None or _dispatcher_pid != os.getpid():
+                _dispatcher = BackgroundPublisher(
+                    publisher_factory=lambda: ConfirmPublisher(
+                        host=RABBITMQ_HOST,
+                        user=RABBITMQ_USER,
+                        password=RABBITMQ_PASS,
+                        exchange=RABBITMQ_EXCHANGE,
+                        max_in_flight=RABBITMQ_MAX_IN_FLIGHT,
+                    ),
+                    maxsize=PUBLISH_QUEUE_SIZE,
+                    overflow=PUBLISH_OVERFLOW,
+                    block_timeout=PUBLISH_BLOCK_TIMEOUT,
+                    batch_size=PUBLISH_BATCH_SIZE,
+                    confirm_timeout=PUBLISH_CONFIRM_TIMEOUT,
+                )
+                _dispatcher.start()
+                _dispatcher_pid = os.getpid()
+                atexit.register(_dispatcher.stop)
+    return _dispatcher
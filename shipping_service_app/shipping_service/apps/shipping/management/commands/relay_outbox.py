@@ -0,0 +1,71 @@
+# apps/shipping/management/commands/relay_outbox.py
+import time
+from django.core.management.base import BaseCommand, CommandError
+from apps.shipping.dispatcher import PUBLISH_IN_PROCESS, PUBLISH_CONFIRM_TIMEOUT
+from apps.shipping.outbox import relay_batch
+from apps.shipping.publisher import ConfirmPublisher
+from apps.shipping.utils import (
+    RABBITMQ_HOST, RABBITMQ_USER, RABBITMQ_PASS, RABBITMQ_EXCHANGE, RABBITMQ_MAX_IN_FLIGHT,
+)
+
+
+class Command(BaseCommand):
+    help = "Drain the shipment outbox table and publish pending events to RabbitMQ."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--max-in-flight", type=int, default=RABBITMQ_MAX_IN_FLIGHT,
+                            help="Maximum number of unconfirmed messages.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Seconds to sleep when the outbox is empty.")
+        parser.add_argument("--min-age", type=float, default=2 * PUBLISH_CONFIRM_TIMEOUT,
+                            help="Only relay events older than this many seconds, leaving fresh "
+                                 "ones to the API's in-process publisher. Must exceed its confirm "
+                                 "timeout (SHIPPING_PUBLISH_CONFIRM_TIMEOUT).")
+        parser.add_argument("--lease", type=float, default=120.0,
+                            help="Seconds a claimed batch is reserved for this relay while it "
+                                 "waits on confirms.")
+        parser.add_argument("--once", action="store_true",
+                            help="Drain what is pending and exit.")
+
+    def handle(self, *args, **options):
+        if PUBLISH_IN_PROCESS and options["min_age"] <= PUBLISH_CONFIRM_TIMEOUT:
+            # The relay would republish rows the API is still waiting on confirms for
+            raise CommandError(
+                f"--min-age must exceed the in-process confirm timeout ({PUBLISH_CONFIRM_TIMEOUT}s)"
+            )
+        batch_size = options["batch_size"]
+        publisher = ConfirmPublisher(
+            host=RABBITMQ_HOST,
+            user=RABBITMQ_USER,
+            password=RABBITMQ_PASS,
+            exchange=RABBITMQ_EXCHANGE,
+            max_in_flight=options["max_in_flight"],
+        )
+
+        total = 0
+        try:
+            while True:
+                try:
+                    published = relay_batch(
+                        publisher, batch_size=batch_size, min_age=options["min_age"],
+                        lease=options["lease"],
+                    )
+                except Exception as e:
+                    self.stderr.write(f"Outbox relay error: {e}")
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+                    continue
+
+                total += published
+                if published < batch_size:
+                    if options["once"]:
+                        break
+                    time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            publisher.close()
+
+        self.stdout.write(self.style.SUCCESS(f"Relayed {total} outbox events."))
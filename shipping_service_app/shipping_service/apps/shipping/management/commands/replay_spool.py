@@ -0,0 +1,31 @@
+# apps/shipping/management/commands/replay_spool.py
+import time
+from pika.exceptions import AMQPError
+from django.core.management.base import BaseCommand
+from apps.shipping.utils import spool, publish_spooled, get_spool_publisher, SPOOL_RETRY_INTERVAL
+
+
+class Command(BaseCommand):
+    help = "Publish events left in the local spool (e.g. by API workers that exited) to RabbitMQ."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=None,
+                            help="Stop after replaying this many events.")
+        parser.add_argument("--wait", action="store_true",
+                            help="Keep retrying until the broker is reachable and the spool is empty.")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            try:
+                total += spool.replay(publish_spooled, limit=options["limit"])
+                break
+            except (AMQPError, OSError) as e:
+                if not options["wait"]:
+                    self.stderr.write(f"Replay stopped, broker unavailable: {e}")
+                    break
+                time.sleep(SPOOL_RETRY_INTERVAL)
+
+        spool.close()
+        get_spool_publisher().close()
+        self.stdout.write(self.style.SUCCESS(f"Replayed {total} spooled events."))
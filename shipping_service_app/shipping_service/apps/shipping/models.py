@@ -1,4 +1,5 @@
 # shipping/models.py
+import uuid
 from django.db import models
 
 class Shipment(models.Model):
@@ -18,3 +19,22 @@ class Shipment(models.Model):
 
     def __str__(self):
         return f"Shipment {self.id} for Order {self.order_id}"
+
+
+class OutboxEvent(models.Model):
+    """Shipment event written in the same transaction as the shipment change."""
+
+    event_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Lease of the relay currently publishing this row; expired leases are free to take
+    claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"OutboxEvent {self.id} [{self.event_type}]"
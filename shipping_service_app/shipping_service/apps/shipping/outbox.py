@@ -0,0 +1,102 @@
+# apps/shipping/outbox.py
+import logging
+from datetime import timedelta
+from concurrent.futures import Future
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from .models import OutboxEvent
+from .publisher import PublishReturned
+from .utils import encode_event
+from .dispatcher import get_dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+def record_event(event_type, payload):
+    """
+    Store an event in the outbox.
+
+    Call this inside the same ``transaction.atomic()`` block as the shipment
+    change so the event is committed (or rolled back) together with it.
+    Once committed it is handed to the in-process background publisher;
+    ``relay_outbox`` publishes whatever that did not get to.
+    """
+    dispatcher = get_dispatcher()
+    if dispatcher is not None:
+        # Under the "fail" overflow policy this rolls back the shipment change
+        dispatcher.check_capacity()
+
+    event = OutboxEvent.objects.create(event_type=event_type, payload=payload)
+    logger.debug(f"[OUTBOX] recorded event id={event.id} type={event_type}")
+
+    if dispatcher is not None:
+        transaction.on_commit(lambda: dispatcher.submit(event))
+    return event
+
+
+def relay_batch(publisher, batch_size=500, confirm_timeout=30, min_age=0, lease=120):
+    """
+    Publish one batch of pending outbox events and mark them as sent.
+
+    Rows are claimed for ``lease`` seconds in a short SKIP LOCKED
+    transaction, so several relays can run side by side without holding
+    row locks while they wait on the broker; a relay that dies leaves its
+    claim to expire. The lease should comfortably exceed the time to
+    publish a batch and collect its confirms. The whole batch is pipelined through the confirm-mode ``publisher`` and
+    only rows up to the first unconfirmed event are marked sent, to keep
+    per-shipment ordering; the rest stay pending for the next pass. An
+    event the broker returns (no queue binds its type) can never be
+    delivered, so it is marked sent too instead of blocking the ones
+    behind it. ``min_age`` (seconds) skips rows the in-process publisher is
+    still expected to handle. Returns the number of rows marked sent.
+    """
+    now = timezone.now()
+    claimed_until = now + timedelta(seconds=lease)
+    with transaction.atomic():
+        pending = (
+            OutboxEvent.objects.select_for_update(skip_locked=True)
+            .filter(sent_at__isnull=True)
+            .filter(Q(claimed_until__isnull=True) | Q(claimed_until__lte=now))
+        )
+        if min_age:
+            pending = pending.filter(created_at__lte=now - timedelta(seconds=min_age))
+        events = list(pending.order_by("id")[:batch_size])
+        if not events:
+            return 0
+        OutboxEvent.objects.filter(id__in=[e.id for e in events]).update(claimed_until=claimed_until)
+
+    confirms = []
+    for event in events:
+        try:
+            body, properties = encode_event(event.event_type, event.payload, event.event_id)
+            future = publisher.publish(body, routing_key=event.event_type, properties=properties)
+        except Exception as e:
+            future = Future()
+            future.set_exception(e)
+        confirms.append((event, future))
+
+    sent_ids, failed, returned = [], None, 0
+    for event, future in confirms:
+        try:
+            future.result(timeout=confirm_timeout)
+        except PublishReturned as e:
+            logger.warning(f"[OUTBOX] no consumer for event id={event.id} type={event.event_type}: {e}")
+            returned += 1
+        except Exception as e:
+            logger.error(f"[OUTBOX] failed to publish event id={event.id}: {e}")
+            failed = event
+            break
+        sent_ids.append(event.id)
+
+    with transaction.atomic():
+        # Only touch rows still under our claim: past the lease another relay may own them
+        ours = OutboxEvent.objects.filter(claimed_until=claimed_until)
+        if sent_ids:
+            ours.filter(id__in=sent_ids).update(sent_at=timezone.now(), claimed_until=None)
+        if failed is not None:
+            ours.filter(id=failed.id).update(attempts=failed.attempts + 1)
+        ours.filter(id__in=[e.id for e in events]).update(claimed_until=None)
+
+    logger.info(f"[OUTBOX] relayed {len(sent_ids)}/{len(events)} events ({returned} unroutable)")
+    return len(sent_ids)
@@ -0,0 +1,348 @@
+# apps/shipping/publisher.py
+import time, uuid, logging, threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import pika
+from pika.exceptions import AMQPError, AMQPConnectionError
+
+logger = logging.getLogger(__name__)
+
+
+class PublishNacked(AMQPError):
+    """The broker negatively acknowledged (nacked) a published message."""
+
+
+class PublishReturned(AMQPError):
+    """The broker returned a mandatory message because no queue is bound for its routing key."""
+
+
+class PublisherStats:
+    """Thread-safe publish counters and latency totals."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.published = 0
+            self.failed = 0
+            self.latency_total = 0.0
+            self.latency_max = 0.0
+
+    def record_publish(self, elapsed):
+        with self._lock:
+            self.published += 1
+            self.latency_total += elapsed
+            self.latency_max = max(self.latency_max, elapsed)
+
+    def record_failure(self):
+        with self._lock:
+            self.failed += 1
+
+    def snapshot(self):
+        with self._lock:
+            avg = self.latency_total / self.published if self.published else 0.0
+            return {
+                "published": self.published,
+                "failed": self.failed,
+                "latency_avg_ms": round(avg * 1000, 3),
+                "latency_max_ms": round(self.latency_max * 1000, 3),
+            }
+
+    def samples(self):
+        """Raw counters and latencies (seconds) for metrics export."""
+        with self._lock:
+            return {
+                "published": self.published,
+                "failed": self.failed,
+                "latency_total": self.latency_total,
+                "latency_max": self.latency_max,
+            }
+
+
+class ConfirmPublisher:
+    """
+    Publisher-confirm mode publisher that pipelines messages.
+
+    A pika SelectConnection runs on a background IO thread. ``publish`` is
+    safe to call from any thread and returns a ``concurrent.futures.Future``
+    that resolves to True when the broker acks the message, or fails with
+    PublishNacked when it is nacked. Messages are mandatory: one the broker
+    returns as unroutable (no consumer queue bound yet) fails with
+    PublishReturned even though its confirm is an ack. Acks with ``multiple=True`` resolve every
+    outstanding delivery tag up to the acked one. At most ``max_in_flight``
+    messages are unconfirmed at any time; ``publish`` blocks once the window
+    is full, for up to ``window_timeout`` seconds. When the IO loop stops,
+    every queued or unconfirmed message fails its future and frees its slot.
+    """
+
+    def __init__(self, host, user, password, exchange, max_in_flight=1000, connect_timeout=10,
+                 window_timeout=30):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.exchange = exchange
+        self.max_in_flight = max_in_flight
+        self.connect_timeout = connect_timeout
+        self.window_timeout = window_timeout
+        self.stats = PublisherStats()
+
+        self._window = threading.BoundedSemaphore(max_in_flight)
+        self._start_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._thread = None
+        self._connection = None
+        self._channel = None
+        self._open_error = None
+
+        # Futures handed to the IO loop but not yet published, guarded by
+        # _queue_lock; publishing is refused once the loop is going away
+        self._queue_lock = threading.Lock()
+        self._queued = {}  # id(future) -> future
+        self._accepting = False
+
+        # Only touched from the IO thread
+        self._pending = OrderedDict()  # delivery_tag -> (future, start time, message_id)
+        self._returned = set()  # message ids returned as unroutable, awaiting their confirm
+        self._next_tag = 1
+
+    # ------------------------
+    # IO thread lifecycle
+    # ------------------------
+    @property
+    def in_flight(self):
+        return len(self._queued) + len(self._pending)
+
+    @property
+    def is_open(self):
+        return self._ready.is_set() and self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Connect and wait until the channel is in confirm mode."""
+        with self._start_lock:
+            if self.is_open:
+                return
+            if self._thread is not None and self._thread.is_alive():
+                # The old loop is still shutting down and owns self._connection
+                self._thread.join(timeout=self.connect_timeout)
+                if self._thread.is_alive() or self._connection is not None:
+                    raise AMQPConnectionError("Previous RabbitMQ IO thread is still running")
+            self._ready.clear()
+            self._open_error = None
+            self._thread = threading.Thread(
+                target=self._run, name="rabbitmq-confirm-publisher", daemon=True
+            )
+            self._thread.start()
+            if not self._ready.wait(self.connect_timeout) or self._open_error:
+                raise AMQPConnectionError(self._open_error or "Timed out connecting to RabbitMQ")
+
+    def _run(self):
+        credentials = pika.PlainCredentials(self.user, self.password)
+        try:
+            self._connection = pika.SelectConnection(
+                pika.ConnectionParameters(host=self.host, credentials=credentials),
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_open_error,
+                on_close_callback=self._on_connection_closed,
+            )
+            self._connection.ioloop.start()
+        except Exception as e:
+            self._open_error = self._open_error or e
+            self._ready.set()
+        finally:
+            self._shutdown(AMQPConnectionError("RabbitMQ IO loop stopped"))
+
+    def _shutdown(self, error):
+        """Fail everything still queued or unconfirmed once the IO loop is gone."""
+        self._ready.clear()
+        with self._queue_lock:
+            self._accepting = False
+            queued, self._queued = list(self._queued.values()), {}
+        for future in queued:
+            self._window.release()
+            self.stats.record_failure()
+            future.set_exception(error)
+        self._fail_pending(error)
+        self._channel = None
+        self._connection = None
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_open_error(self, connection, error):
+        self._open_error = error
+        self._ready.set()
+        connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        self._next_tag = 1
+        self._returned.clear()
+        channel.add_on_close_callback(self._on_channel_closed)
+        # Basic.Return for an unroutable message arrives before its ack
+        channel.add_on_return_callback(self._on_return)
+
+        # Declare the topic exchange, then enable confirms
+        channel.exchange_declare(
+            exchange=self.exchange,
+            exchange_type="topic",
+            durable=True,
+            callback=lambda _: channel.confirm_delivery(
+                ack_nack_callback=self._on_confirm,
+                callback=lambda _: self._on_confirm_mode(),
+            ),
+        )
+
+    def _on_confirm_mode(self):
+        with self._queue_lock:
+            self._accepting = True
+        self._ready.set()
+
+    def _on_channel_closed(self, channel, reason):
+        logger.warning(f"Confirm publisher channel closed: {reason}")
+        self._channel = None
+        if self._connection.is_open:
+            self._connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        self._ready.clear()
+        with self._queue_lock:
+            self._accepting = False
+        self._fail_pending(AMQPConnectionError(reason))
+        connection.ioloop.stop()
+
+    def _fail_pending(self, error):
+        while self._pending:
+            _, (future, _, _) = self._pending.popitem(last=False)
+            self._window.release()
+            self.stats.record_failure()
+            future.set_exception(error)
+
+    # ------------------------
+    # Confirms
+    # ------------------------
+    def _on_return(self, channel, method, properties, body):
+        logger.warning(f"Unroutable message returned: routing_key={method.routing_key} ({method.reply_text})")
+        self._returned.add(properties.message_id)
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        acked = isinstance(method, pika.spec.Basic.Ack)
+
+        if method.multiple:
+            tags = [tag for tag in self._pending if tag <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+
+        for tag in tags:
+            entry = self._pending.pop(tag, None)
+            if entry is None:
+                continue
+            future, start, message_id = entry
+            self._window.release()
+            if message_id in self._returned:
+                self._returned.discard(message_id)
+                self.stats.record_failure()
+                future.set_exception(PublishReturned(f"Message {tag} had no queue to route to"))
+            elif acked:
+                self.stats.record_publish(time.perf_counter() - start)
+                future.set_result(True)
+            else:
+                self.stats.record_failure()
+                future.set_exception(PublishNacked(f"Message {tag} was nacked by the broker"))
+
+    # ------------------------
+    # Publishing
+    # ------------------------
+    def publish(self, body, routing_key, properties=None):
+        """Queue a message for publishing and return a Future for its confirm."""
+        if not self.is_open:
+            self.start()
+
+        properties = properties or pika.BasicProperties(delivery_mode=2)  # Persistent
+        # Returned messages are matched to their confirm by message id
+        properties.message_id = properties.message_id or uuid.uuid4().hex
+        future = Future()
+
+        if not self._window.acquire(timeout=self.window_timeout):
+            self.stats.record_failure()
+            raise AMQPConnectionError(
+                f"No publish window slot within {self.window_timeout}s ({self.max_in_flight} unconfirmed)"
+            )
+
+        def _publish():
+            with self._queue_lock:
+                if self._queued.pop(id(future), None) is None:
+                    return  # already failed by _shutdown
+            channel = self._channel
+            if channel is None or not channel.is_open:
+                self._window.release()
+                future.set_exception(AMQPConnectionError("Channel is not open"))
+                return
+            tag = self._next_tag
+            self._next_tag += 1
+            self._pending[tag] = (future, time.perf_counter(), properties.message_id)
+            try:
+                channel.basic_publish(
+                    exchange=self.exchange, routing_key=routing_key, body=body, properties=properties,
+                    mandatory=True,
+                )
+            except Exception as e:
+                self._pending.pop(tag, None)
+                self._window.release()
+                future.set_exception(e)
+
+        with self._queue_lock:
+            accepting = self._accepting
+            if accepting:
+                self._queued[id(future)] = future
+        if not accepting:
+            self._window.release()
+            future.set_exception(AMQPConnectionError("Confirm publisher is not connected"))
+            return future
+        try:
+            self._connection.ioloop.add_callback_threadsafe(_publish)
+        except Exception as e:
+            with self._queue_lock:
+                queued = self._queued.pop(id(future), None)
+            if queued is not None:
+                self._window.release()
+                future.set_exception(e)
+        return future
+
+    def close(self):
+        """Close the connection; unconfirmed messages fail their futures."""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        try:
+            self._connection.ioloop.add_callback_threadsafe(self._connection.close)
+        except Exception:
+            pass
+        self._thread.join(timeout=self.connect_timeout)
+
+
+PUBLISHER_METRICS = (
+    ("shipping_publisher_messages_total", "counter", "Messages published (confirmed, in confirm mode).",
+     lambda p, s: s["published"]),
+    ("shipping_publisher_failures_total", "counter", "Messages that failed, were nacked or returned.",
+     lambda p, s: s["failed"]),
+    ("shipping_publisher_latency_seconds_sum", "counter", "Total publish (to confirm) latency.",
+     lambda p, s: s["latency_total"]),
+    ("shipping_publisher_latency_max_seconds", "gauge", "Slowest publish (to confirm) so far.",
+     lambda p, s: s["latency_max"]),
+    ("shipping_publisher_in_flight", "gauge", "Messages queued or awaiting a broker confirm.",
+     lambda p, s: p.in_flight),
+)
+
+
+def render_metrics(publishers):
+    """Prometheus text for ``{name: publisher}``; None entries (never created) are skipped."""
+    samples = {name: (p, p.stats.samples()) for name, p in sorted(publishers.items()) if p is not None}
+    lines = []
+    for metric, kind, help_text, value in PUBLISHER_METRICS:
+        values = [(name, value(p, s)) for name, (p, s) in samples.items()]
+        if values:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            lines += [f'{metric}{{publisher="{name}"}} {v}' for name, v in values]
+    return "\n".join(lines) + "\n" if lines else ""
@@ -0,0 +1,169 @@
+# apps/shipping/spool.py
+import os, time, zlib, fcntl, struct, logging, threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# 4-byte big-endian body length + 4-byte CRC32 of the body
+HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".spool"
+CHECKPOINT_SUFFIX = ".ack"
+
+
+class SpoolFull(Exception):
+    """The spool reached its configured size limit."""
+
+
+def _read_records(path, offset=0):
+    """Yield (end_offset, body) for every intact record after ``offset``."""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, crc = HEADER.unpack(header)
+            body = f.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                # Torn write from a crash: everything after it is unusable
+                logger.warning(f"[SPOOL] truncated record in {path.name} at offset {offset}")
+                return
+            offset = f.tell()
+            yield offset, body
+
+
+class EventSpool:
+    """
+    Append-only on-disk spool for events the broker could not take.
+
+    Each process writes its own segment files (``<ns>-<pid>.spool``) holding
+    length-prefixed, CRC-checked records. The active segment is flock'ed by
+    its writer and rolls over at ``segment_bytes``; writes are fsync'ed every
+    ``fsync_every`` records or ``fsync_interval`` seconds, whichever comes
+    first. ``replay`` drains unlocked segments oldest-first and keeps a
+    ``.ack`` checkpoint so a partially replayed segment resumes where it
+    stopped.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, max_bytes=1024 * 1024 * 1024,
+                 fsync_every=100, fsync_interval=1.0):
+        self.directory = Path(directory)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+
+        self._lock = threading.RLock()
+        self._file = None
+        self._path = None
+        self._pid = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    # ------------------------
+    # Writing
+    # ------------------------
+    def _open_segment(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._path = self.directory / f"{time.time_ns():020d}-{os.getpid()}{SEGMENT_SUFFIX}"
+        self._file = open(self._path, "ab")
+        fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._pid = os.getpid()
+        logger.info(f"[SPOOL] opened segment {self._path.name}")
+
+    def _seal(self):
+        """Sync and unlock the active segment so the replayer may take it."""
+        if self._file is None:
+            return
+        self._sync()
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        self._path = None
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def size(self):
+        return sum(p.stat().st_size for p in self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def append(self, body):
+        """Durably queue one encoded message body."""
+        if isinstance(body, str):
+            body = body.encode()
+        record = HEADER.pack(len(body), zlib.crc32(body)) + body
+
+        with self._lock:
+            if self._file is not None and self._pid != os.getpid():
+                # Inherited across a fork: leave the parent's segment alone
+                self._file = None
+            if self._file is None:
+                if self.directory.exists() and self.size() + len(record) > self.max_bytes:
+                    raise SpoolFull(f"Spool {self.directory} exceeds {self.max_bytes} bytes")
+                self._open_segment()
+
+            self._file.write(record)
+            self._unsynced += 1
+            if (self._unsynced >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+            if self._file.tell() >= self.segment_bytes:
+                self._seal()
+
+    def has_pending(self):
+        return self.directory.exists() and any(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+    # ------------------------
+    # Replaying
+    # ------------------------
+    def replay(self, publish, limit=None):
+        """
+        Publish spooled bodies in order with ``publish(body)``.
+
+        Seals this process's active segment first, then walks every segment
+        no live writer holds. Stops at the first publish failure, keeping a
+        checkpoint. Returns the number of records replayed.
+        """
+        with self._lock:
+            self._seal()
+
+        replayed = 0
+        for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+            with open(path, "rb") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # still being written by another process
+
+                checkpoint = path.with_suffix(CHECKPOINT_SUFFIX)
+                done = int(checkpoint.read_text() or 0) if checkpoint.exists() else 0
+                try:
+                    for end, body in _read_records(path, done):
+                        publish(body)
+                        done = end
+                        replayed += 1
+                        if limit and replayed >= limit:
+                            self._write_checkpoint(checkpoint, done)
+                            return replayed
+                except Exception as e:
+                    self._write_checkpoint(checkpoint, done)
+                    logger.warning(f"[SPOOL] replay of {path.name} stopped after {replayed} events: {e}")
+                    raise
+
+                path.unlink()
+                checkpoint.unlink(missing_ok=True)
+                logger.info(f"[SPOOL] replayed and removed segment {path.name}")
+        return replayed
+
+    @staticmethod
+    def _write_checkpoint(checkpoint, offset):
+        tmp = checkpoint.with_suffix(".tmp")
+        tmp.write_text(str(offset))
+        os.replace(tmp, checkpoint)
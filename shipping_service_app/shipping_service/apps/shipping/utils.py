@@ -1,6 +1,13 @@
-import json, pika, logging, os
-from tenacity import retry, stop_after_attempt, wait_exponential
+import pika, logging, os, time, threading
+from pathlib import Path
+from pika.exceptions import AMQPError
 from dotenv import load_dotenv
+from django.db import close_old_connections
+from django.utils import timezone
+from .models import OutboxEvent
+from .publisher import ConfirmPublisher
+from .spool import EventSpool
+from ecommerce_messaging.envelope import build_envelope, encode, decode, CONTENT_TYPE_JSON, CONTENT_TYPE_MSGPACK
 
 load_dotenv()
 
@@ -10,46 +17,109 @@ logger = logging.getLogger(__name__)
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER")
 RABBITMQ_PASS = os.getenv("RABBITMQ_PASSWORD")
-RABBITMQ_QUEUE = os.getenv("RABBITMQ_QUEUE")
-
-# Retry up to 5 times with exponential backoff (2s → 30s)
-@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=2, min=2, max=30))
-def publish_event(event_type, payload):
-    """Publish event to RabbitMQ with retry, logging, and DLQ."""
-    credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASS)
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
-    )
-    channel = connection.channel()
-
-    # ------------------------
-    # Declare Dead Letter Queue (DLQ)
-    # ------------------------
-    dlq_name = f"{RABBITMQ_QUEUE}.dlq"
-    channel.queue_declare(queue=dlq_name, durable=True)
-
-    # ------------------------
-    # Declare Main Queue with DLQ Binding
-    # ------------------------
-    args = {
-        "x-dead-letter-exchange": "",
-        "x-dead-letter-routing-key": dlq_name,
-    }
-    channel.queue_declare(queue=RABBITMQ_QUEUE, durable=True, arguments=args)
-
-    # ------------------------
-    # Publish Message
-    # ------------------------
-    message = json.dumps({"type": event_type, "data": payload})
-    channel.basic_publish(
-        exchange="",
-        routing_key=RABBITMQ_QUEUE,
-        body=message,
-        properties=pika.BasicProperties(delivery_mode=2),  # Persistent
-    )
+# Topic exchange for shipment events; the event type is the routing key
+RABBITMQ_EXCHANGE = os.getenv("RABBITMQ_EXCHANGE", "shipping_events")
+RABBITMQ_MAX_IN_FLIGHT = int(os.getenv("RABBITMQ_MAX_IN_FLIGHT", 1000))
+
+# AMQP priority per event type (0-9, higher first). Consumer queues are
+# declared with x-max-priority so events that drive stock and customer
+# visible status overtake the rest during a backlog.
+EVENT_PRIORITIES = {
+    "shipment.shipped": 9,
+    "shipment.paid": 5,
+    "shipment.updated": 1,
+    "shipment.deleted": 1,
+}
+
+# Wire format of published events (application/json or application/msgpack)
+EVENT_CONTENT_TYPE = os.getenv("EVENT_CONTENT_TYPE", CONTENT_TYPE_JSON)
+
+# Local spool used while the broker is unreachable
+SPOOL_DIR = os.getenv("SHIPPING_SPOOL_DIR", str(Path(__file__).resolve().parents[2] / "spool"))
+SPOOL_MAX_BYTES = int(os.getenv("SHIPPING_SPOOL_MAX_BYTES", 1024 * 1024 * 1024))
+SPOOL_RETRY_INTERVAL = float(os.getenv("SHIPPING_SPOOL_RETRY_INTERVAL", 5))
+SPOOL_CONFIRM_TIMEOUT = float(os.getenv("SHIPPING_SPOOL_CONFIRM_TIMEOUT", 30))
+
+spool = EventSpool(SPOOL_DIR, max_bytes=SPOOL_MAX_BYTES)
+_replayer = None
+_replayer_lock = threading.Lock()
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_spool_publisher():
+    """Return the process-wide confirm-mode publisher used to replay the spool."""
+    global _publisher
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = ConfirmPublisher(
+                    host=RABBITMQ_HOST,
+                    user=RABBITMQ_USER,
+                    password=RABBITMQ_PASS,
+                    exchange=RABBITMQ_EXCHANGE,
+                    max_in_flight=RABBITMQ_MAX_IN_FLIGHT,
+                )
+    return _publisher
 
-    connection.close()
 
-    logger.info(
-        f"✅ Published event: type={event_type}, payload={payload}, queue={RABBITMQ_QUEUE}"
+def event_properties(envelope, content_type=EVENT_CONTENT_TYPE):
+    """AMQP properties for an encoded envelope."""
+    return pika.BasicProperties(
+        content_type=content_type,
+        message_id=envelope["id"],
+        type=envelope["type"],
+        timestamp=int(envelope["ts"]),
+        priority=EVENT_PRIORITIES.get(envelope["type"], 0),
+        delivery_mode=2,  # Persistent
     )
+
+
+def encode_event(event_type, payload, event_id=None):
+    """Wrap an event in the versioned envelope and return (body, properties)."""
+    envelope = build_envelope(event_type, payload, event_id=event_id)
+    return encode(envelope, EVENT_CONTENT_TYPE), event_properties(envelope)
+
+
+def publish_spooled(body):
+    """
+    Publish a spooled body, routed by the event type in its envelope, and
+    wait for the broker's confirm before its outbox row is marked sent.
+    The row stays pending until then, so the relay still delivers the event
+    if this spool is lost with its container.
+    """
+    envelope = decode(body)
+    # Spooled bodies are envelopes: JSON objects start with "{", anything else is msgpack
+    content_type = CONTENT_TYPE_JSON if body[:1] == b"{" else CONTENT_TYPE_MSGPACK
+    properties = event_properties(envelope, content_type)
+    future = get_spool_publisher().publish(body, routing_key=envelope["type"], properties=properties)
+    future.result(timeout=SPOOL_CONFIRM_TIMEOUT)
+    OutboxEvent.objects.filter(event_id=envelope["id"], sent_at__isnull=True).update(sent_at=timezone.now())
+
+
+def _replay_spool():
+    """Drain the spool, retrying until the broker takes everything."""
+    while spool.has_pending():
+        close_old_connections()
+        try:
+            count = spool.replay(publish_spooled)
+        except (AMQPError, OSError) as e:
+            logger.warning(f"[SPOOL] broker still unavailable ({e}), retrying in {SPOOL_RETRY_INTERVAL}s")
+            time.sleep(SPOOL_RETRY_INTERVAL)
+            continue
+        if count:
+            logger.info(f"[SPOOL] replayed {count} events to RabbitMQ")
+        else:
+            # What is left is locked by the processes still writing it
+            time.sleep(SPOOL_RETRY_INTERVAL)
+
+
+def start_spool_replay():
+    """Start the background spool replayer unless one is already running."""
+    global _replayer
+    with _replayer_lock:
+        if _replayer is None or not _replayer.is_alive():
+            _replayer = threading.Thread(target=_replay_spool, name="shipping-spool-replay", daemon=True)
+            _replayer.start()
+
@@ -5,16 +5,17 @@ from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.exceptions import PermissionDenied
 from django.shortcuts import get_object_or_404
+from django.db import transaction
 from .models import Shipment
 from .serializers import ShipmentSerializer
 from .messages import VALIDATION_MESSAGES
-from .utils import publish_event
+from .outbox import record_event
 from .authentication import ServiceJWTAuthentication
 from apps.shipping.permissions import IsJWTAdminUser
 from apps.shipping.cache_utils import (
     get_cached_response,
     set_cached_response,
-    invalidate_cache_patterns,
+    invalidate_shipment_caches,
 )
 
 logger = logging.getLogger(__name__)
@@ -85,9 +86,7 @@ class ShipmentViewSet(viewsets.ModelViewSet):
 
         shipments = Shipment.objects.all().order_by(sort_order)
         serializer = self.get_serializer(shipments, many=True)
-        data = serializer.data
-        set_cached_response("all_shipments", request, data)
-        return Response(data)
+        return set_cached_response("all_shipments", request, serializer.data)
 
     @action(detail=False, methods=["get"], permission_classes=[IsAuthenticated])
     def my_shipments(self, request):
@@ -97,9 +96,7 @@ class ShipmentViewSet(viewsets.ModelViewSet):
 
         shipments = Shipment.objects.filter(user_id=request.user.id)
         serializer = self.get_serializer(shipments, many=True)
-        data = serializer.data
-        set_cached_response("my_shipments", request, data)
-        return Response(data)
+        return set_cached_response("my_shipments", request, serializer.data)
 
     # ------------------------
     # Create shipment from order
@@ -144,10 +141,11 @@ class ShipmentViewSet(viewsets.ModelViewSet):
 
         serializer = self.get_serializer(shipment, data=request.data, partial=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save(user_id=user.id)
+        with transaction.atomic():
+            serializer.save(user_id=user.id)
+            record_event("shipment.updated", {"shipment_id": shipment.id, "user_id": user.id})
 
-        publish_event("shipment.updated", {"shipment_id": shipment.id, "user_id": user.id})
-        invalidate_cache_patterns(["my_shipments", "all_shipments"])
+        invalidate_shipment_caches(user.id)
 
         return get_response("success.shipment_created", shipment_id=shipment.id)
 
@@ -165,13 +163,12 @@ class ShipmentViewSet(viewsets.ModelViewSet):
         if shipment.status != "pending":
             return get_response("shipment.not_pending_payment")
 
-        shipment.status = "paid"
-        shipment.save()
+        with transaction.atomic():
+            shipment.status = "paid"
+            shipment.save()
+            record_event("shipment.paid", {"shipment_id": shipment.id, "order_id": shipment.order_id})
 
-
-
-        publish_event("shipment.paid", {"shipment_id": shipment.id, "order_id": shipment.order_id})
-        invalidate_cache_patterns(["my_shipments", "all_shipments"])
+        invalidate_shipment_caches(shipment.user_id)
         return get_response("success.shipment_paid", shipment_id=shipment.id)
 
     # ------------------------
@@ -203,21 +200,21 @@ class ShipmentViewSet(viewsets.ModelViewSet):
             return get_response("order_service_unavailable", detail=str(e))
 
         # Update shipment status
-        shipment.status = "shipped"
-        shipment.save()
-        
-        publish_event(
-            "shipment.shipped",
-            {
-                "shipment_id": shipment.id,
-                "order_id": shipment.order_id,
-                "product_id": product_id,
-                "quantity": quantity,
-                "tracking_number": shipment.tracking_number,
-            },
-        )
-
-        invalidate_cache_patterns(["my_shipments", "all_shipments"])
+        with transaction.atomic():
+            shipment.status = "shipped"
+            shipment.save()
+            record_event(
+                "shipment.shipped",
+                {
+                    "shipment_id": shipment.id,
+                    "order_id": shipment.order_id,
+                    "product_id": product_id,
+                    "quantity": quantity,
+                    "tracking_number": shipment.tracking_number,
+                },
+            )
+
+        invalidate_shipment_caches(shipment.user_id)
         return get_response("success.shipment_shipped", shipment_id=shipment.id)
 
     # ------------------------
@@ -226,11 +223,12 @@ class ShipmentViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["delete"], permission_classes=[IsJWTAdminUser])
     def delete_shipment(self, request, pk=None):
         shipment = get_object_or_404(Shipment, pk=pk)
-        shipment_id = shipment.id
-        shipment.delete()
+        shipment_id, owner_id = shipment.id, shipment.user_id
+        with transaction.atomic():
+            shipment.delete()
+            record_event("shipment.deleted", {"shipment_id": shipment_id})
 
-        publish_event("shipment.deleted", {"shipment_id": shipment_id})
-        invalidate_cache_patterns(["my_shipments", "all_shipments"])
+        invalidate_shipment_caches(owner_id)
         return get_response("success.shipment_deleted", shipment_id=shipment_id)
 
     # ------------------------
@@ -239,10 +237,13 @@ class ShipmentViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=["patch"], permission_classes=[IsJWTAdminUser])
     def update_shipment(self, request, pk=None):
         shipment = get_object_or_404(Shipment, pk=pk)
+        previous_owner_id = shipment.user_id
         serializer = ShipmentSerializer(shipment, data=request.data, partial=True)
         if serializer.is_valid():
-            serializer.save()
-            publish_event("shipment.updated", {"shipment_id": shipment.id})
-            invalidate_cache_patterns(["my_shipments", "all_shipments"])
+            with transaction.atomic():
+                serializer.save()
+                record_event("shipment.updated", {"shipment_id": shipment.id})
+            # Both the old and the new owner's lists change on a transfer
+            invalidate_shipment_caches(previous_owner_id, shipment.user_id)
             return get_response("success.shipment_updated", shipment_id=shipment.id)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
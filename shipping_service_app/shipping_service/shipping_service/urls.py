@@ -1,6 +1,8 @@
 # project/urls.py
 from django.urls import path, include
+from apps.shipping.cache_metrics import metrics_view
 
 urlpatterns = [
     path("api/", include("apps.shipping.urls")),
+    path("metrics", metrics_view),
 ]
@@ -0,0 +1,143 @@
+import os
+from concurrent.futures import Future
+from django.test import TestCase
+from unittest.mock import MagicMock, patch
+from apps.shipping.models import OutboxEvent
+from apps.shipping.dispatcher import BackgroundPublisher, PublishQueueFull
+from apps.shipping.publisher import ConfirmPublisher, PublishNacked, PublishReturned
+from apps.shipping.spool import SpoolFull
+
+
+def confirmed():
+    future = Future()
+    future.set_result(True)
+    return future
+
+
+class BackgroundPublisherTests(TestCase):
+    def setUp(self):
+        self.publisher = MagicMock()
+        self.publisher.publish.side_effect = lambda body, **kwargs: confirmed()
+        self.event = OutboxEvent.objects.create(event_type="shipment.paid", payload={"order_id": 101})
+
+    def test_published_batch_is_marked_sent(self):
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10)
+        dispatcher.submit(self.event)
+
+        dispatcher.publish_batch([dispatcher._queue.get_nowait()])
+
+        self.event.refresh_from_db()
+        self.assertIsNotNone(self.event.sent_at)
+        stats = dispatcher.stats.snapshot(dispatcher.depth)
+        self.assertEqual(stats["enqueued"], 1)
+        self.assertEqual(stats["published"], 1)
+        self.assertEqual(stats["queue_depth"], 0)
+
+    def test_returned_event_is_marked_sent_and_counted(self):
+        returned = Future()
+        returned.set_exception(PublishReturned("NO_ROUTE"))
+        self.publisher.publish.side_effect = [returned, confirmed()]
+        later = OutboxEvent.objects.create(event_type="shipment.shipped", payload={"order_id": 101})
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10)
+        dispatcher.submit(self.event)
+        dispatcher.submit(later)
+
+        dispatcher.publish_batch([dispatcher._queue.get_nowait() for _ in range(2)])
+
+        self.assertFalse(OutboxEvent.objects.filter(sent_at__isnull=True).exists())
+        stats = dispatcher.stats.snapshot()
+        self.assertEqual(stats["returned"], 1)
+        self.assertEqual(stats["published"], 1)
+
+    def test_unconfirmed_event_stops_the_batch(self):
+        nacked = Future()
+        nacked.set_exception(PublishNacked("nacked"))
+        later = OutboxEvent.objects.create(event_type="shipment.shipped", payload={"order_id": 101})
+        self.publisher.publish.side_effect = [nacked, confirmed()]
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10, confirm_timeout=0.01)
+        dispatcher.submit(self.event)
+        dispatcher.submit(later)
+
+        dispatcher.publish_batch([dispatcher._queue.get_nowait() for _ in range(2)])
+
+        # The shipped event was confirmed but must not overtake the failed paid event
+        self.assertEqual(OutboxEvent.objects.filter(sent_at__isnull=True).count(), 2)
+        self.assertEqual(dispatcher.stats.snapshot()["failed"], 2)
+
+    def test_drop_policy_leaves_event_to_relay(self):
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=1, overflow="drop")
+
+        self.assertTrue(dispatcher.submit(self.event))
+        self.assertFalse(dispatcher.submit(self.event))
+        self.assertEqual(dispatcher.stats.snapshot()["dropped"], 1)
+
+    def test_fail_policy_rejects_writes_when_full(self):
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=1, overflow="fail")
+        dispatcher.check_capacity()
+        dispatcher.submit(self.event)
+
+        with self.assertRaises(PublishQueueFull):
+            dispatcher.check_capacity()
+
+    @patch("apps.shipping.dispatcher.start_spool_replay")
+    @patch("apps.shipping.dispatcher.spool")
+    def test_broker_down_spools_and_leaves_rows_pending(self, mock_spool, mock_replay):
+        self.publisher.publish.side_effect = ConnectionError("broker down")
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10)
+        dispatcher.submit(self.event)
+
+        dispatcher.publish_batch([dispatcher._queue.get_nowait()])
+
+        mock_spool.append.assert_called_once()
+        mock_replay.assert_called_once()
+        # The outbox row is only marked sent by the spool replay's confirm
+        self.event.refresh_from_db()
+        self.assertIsNone(self.event.sent_at)
+        stats = dispatcher.stats.snapshot()
+        self.assertEqual(stats["spooled"], 1)
+        self.assertEqual(stats["failed"], 0)
+
+    @patch("apps.shipping.dispatcher.spool")
+    def test_broker_down_without_spool_space_leaves_rows_to_relay(self, mock_spool):
+        mock_spool.append.side_effect = SpoolFull("full")
+        self.publisher.publish.side_effect = ConnectionError("broker down")
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10)
+        dispatcher.submit(self.event)
+
+        dispatcher.publish_batch([dispatcher._queue.get_nowait()])
+
+        self.event.refresh_from_db()
+        self.assertIsNone(self.event.sent_at)
+        self.assertEqual(dispatcher.stats.snapshot()["failed"], 1)
+
+    def test_stats_are_exported_on_the_metrics_endpoint(self):
+        dispatcher = BackgroundPublisher(lambda: self.publisher, maxsize=10)
+        dispatcher.submit(self.event)
+        dispatcher.submit(self.event)
+        dispatcher.publish_batch([dispatcher._queue.get_nowait()])
+
+        with patch("apps.shipping.dispatcher._dispatcher", dispatcher), \
+                patch("apps.shipping.dispatcher._dispatcher_pid", os.getpid()), \
+                patch("apps.shipping.cache_metrics.METRICS_TOKEN", "scrape-me"):
+            response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me")
+
+        body = response.content.decode()
+        self.assertIn("shipping_dispatch_queue_depth 1", body)
+        self.assertIn('shipping_dispatch_events_total{outcome="published"} 1', body)
+        self.assertIn("shipping_dispatch_latency_seconds_count 1", body)
+
+    def test_publisher_stats_are_exported_on_the_metrics_endpoint(self):
+        publisher = ConfirmPublisher("rabbitmq", "guest", "guest", "shipping_events")
+        publisher.stats.record_publish(0.004)
+        publisher.stats.record_failure()
+        dispatcher = BackgroundPublisher(lambda: publisher)
+        dispatcher._publisher = publisher
+
+        with patch("apps.shipping.dispatcher._dispatcher", dispatcher), \
+                patch("apps.shipping.dispatcher._dispatcher_pid", os.getpid()), \
+                patch("apps.shipping.cache_metrics.METRICS_TOKEN", "scrape-me"):
+            body = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer scrape-me").content.decode()
+
+        self.assertIn('shipping_publisher_messages_total{publisher="dispatcher"} 1', body)
+        self.assertIn('shipping_publisher_failures_total{publisher="dispatcher"} 1', body)
+        self.assertIn('shipping_publisher_in_flight{publisher="dispatcher"} 0', body)
@@ -0,0 +1,41 @@
+from unittest import skipIf
+from django.test import SimpleTestCase
+from ecommerce_messaging import envelope
+from ecommerce_messaging.envelope import build_envelope, encode, decode, EnvelopeError
+from apps.shipping.utils import encode_event
+
+
+class EnvelopeTests(SimpleTestCase):
+    def test_json_round_trip(self):
+        message = build_envelope("shipment.paid", {"order_id": 101})
+        decoded = decode(encode(message), envelope.CONTENT_TYPE_JSON)
+        self.assertEqual(decoded, message)
+
+    @skipIf(envelope.msgpack is None, "msgpack not installed")
+    def test_msgpack_round_trip_and_sniffing(self):
+        message = build_envelope("shipment.shipped", {"order_id": 101, "quantity": 2})
+        body = encode(message, envelope.CONTENT_TYPE_MSGPACK)
+        self.assertLess(len(body), len(encode(message)))
+        # Spool replays carry no content_type property
+        self.assertEqual(decode(body), message)
+
+    def test_legacy_body_is_upgraded(self):
+        decoded = decode(b'{"type": "shipment.paid", "data": {"order_id": 7}}')
+        self.assertEqual(decoded["v"], 0)
+        self.assertIsNone(decoded["id"])
+        self.assertEqual(decoded["data"], {"order_id": 7})
+
+    def test_garbage_raises(self):
+        with self.assertRaises(EnvelopeError):
+            decode(b"not an event", envelope.CONTENT_TYPE_JSON)
+
+    def test_encode_event_sets_amqp_properties(self):
+        body, properties = encode_event("shipment.paid", {"order_id": 1}, event_id="abc")
+        self.assertEqual(properties.message_id, "abc")
+        self.assertEqual(properties.type, "shipment.paid")
+        self.assertEqual(decode(body, properties.content_type)["id"], "abc")
+
+    def test_encode_event_sets_priority_by_event_type(self):
+        _, shipped = encode_event("shipment.shipped", {"order_id": 1})
+        _, updated = encode_event("shipment.updated", {"shipment_id": 1})
+        self.assertGreater(shipped.priority, updated.priority)
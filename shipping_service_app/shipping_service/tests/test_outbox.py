@@ -0,0 +1,106 @@
+import json
+from datetime import timedelta
+from concurrent.futures import Future
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from unittest.mock import MagicMock
+from apps.shipping.models import OutboxEvent
+from apps.shipping.outbox import record_event, relay_batch
+from apps.shipping.publisher import PublishReturned
+
+
+def confirmed(error=None):
+    future = Future()
+    if error:
+        future.set_exception(error)
+    else:
+        future.set_result(True)
+    return future
+
+
+class OutboxRelayTests(TestCase):
+    def setUp(self):
+        self.first = record_event("shipment.paid", {"shipment_id": 1, "order_id": 101})
+        self.second = record_event("shipment.shipped", {"shipment_id": 1, "order_id": 101})
+
+    def test_relay_publishes_in_order_and_marks_sent(self):
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda body, **kwargs: confirmed()
+
+        published = relay_batch(publisher, batch_size=10)
+
+        self.assertEqual(published, 2)
+        bodies = [json.loads(c.args[0]) for c in publisher.publish.call_args_list]
+        self.assertEqual([b["type"] for b in bodies], ["shipment.paid", "shipment.shipped"])
+        routing_keys = [c.kwargs["routing_key"] for c in publisher.publish.call_args_list]
+        self.assertEqual(routing_keys, ["shipment.paid", "shipment.shipped"])
+        self.assertFalse(OutboxEvent.objects.filter(sent_at__isnull=True).exists())
+
+    def test_relay_stops_at_first_unconfirmed_event(self):
+        publisher = MagicMock()
+        publisher.publish.side_effect = [confirmed(), confirmed(ConnectionError("nacked"))]
+
+        published = relay_batch(publisher, batch_size=10)
+
+        self.assertEqual(published, 1)
+        self.first.refresh_from_db()
+        self.second.refresh_from_db()
+        self.assertIsNotNone(self.first.sent_at)
+        self.assertIsNone(self.second.sent_at)
+        self.assertEqual(self.second.attempts, 1)
+
+    def test_rows_are_claimed_not_locked_while_awaiting_confirms(self):
+        publisher = MagicMock()
+        other_relay = MagicMock()
+
+        def publish(body, **kwargs):
+            # A second relay running meanwhile finds nothing left to take
+            self.assertEqual(relay_batch(other_relay, batch_size=10), 0)
+            return confirmed()
+        publisher.publish.side_effect = publish
+
+        self.assertEqual(relay_batch(publisher, batch_size=10), 2)
+        other_relay.publish.assert_not_called()
+        self.assertFalse(OutboxEvent.objects.filter(claimed_until__isnull=False).exists())
+
+    def test_failed_batch_releases_its_claim(self):
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda body, **kwargs: confirmed(ConnectionError("down"))
+
+        self.assertEqual(relay_batch(publisher, batch_size=10), 0)
+        # Retried on the next pass rather than after the lease
+        publisher.publish.side_effect = lambda body, **kwargs: confirmed()
+        self.assertEqual(relay_batch(publisher, batch_size=10), 2)
+
+    def test_expired_claim_of_a_dead_relay_is_taken_over(self):
+        OutboxEvent.objects.update(claimed_until=timezone.now() + timedelta(seconds=60))
+        publisher = MagicMock()
+        publisher.publish.side_effect = lambda body, **kwargs: confirmed()
+        self.assertEqual(relay_batch(publisher, batch_size=10), 0)
+
+        OutboxEvent.objects.update(claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(relay_batch(publisher, batch_size=10), 2)
+
+    def test_unroutable_event_does_not_block_the_ones_behind_it(self):
+        OutboxEvent.objects.all().delete()
+        unroutable = record_event("shipment.updated", {"shipment_id": 1})
+        routable = record_event("shipment.paid", {"shipment_id": 1, "order_id": 101})
+        publisher = MagicMock()
+        publisher.publish.side_effect = [confirmed(PublishReturned("NO_ROUTE")), confirmed()]
+
+        self.assertEqual(relay_batch(publisher, batch_size=10), 2)
+        # Nothing is left for the next pass to trip over again
+        self.assertEqual(relay_batch(publisher, batch_size=10), 0)
+
+        unroutable.refresh_from_db()
+        routable.refresh_from_db()
+        self.assertIsNotNone(unroutable.sent_at)
+        self.assertIsNotNone(routable.sent_at)
+        self.assertEqual(publisher.publish.call_count, 2)
+
+    def test_relay_refuses_a_min_age_within_the_dispatcher_confirm_timeout(self):
+        # Rows that young may still be awaiting the API's own confirms
+        with self.assertRaises(CommandError):
+            call_command("relay_outbox", "--once", "--min-age", "5")
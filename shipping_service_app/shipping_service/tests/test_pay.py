@@ -2,7 +2,7 @@ from django.test import TestCase
 from unittest.mock import patch
 from rest_framework.test import APIClient
 from rest_framework import status
-from apps.shipping.models import Shipment
+from apps.shipping.models import Shipment, OutboxEvent
 from types import SimpleNamespace
 
 
@@ -23,9 +23,8 @@ class ShipmentViewSetTests(TestCase):
         for s in Shipment.objects.all():
             print(f"id={s.id}, user_id={s.user_id}, order_id={s.order_id}, status={s.status}")
 
-    @patch("apps.shipping.views.publish_event")  # mock RMQ publisher
     @patch("requests.get")  # mock order service
-    def test_pay_shipment_changes_status_to_paid(self, mock_get, mock_publish):
+    def test_pay_shipment_changes_status_to_paid(self, mock_get):
         
         # Mock order service to simulate successful response
         mock_get.return_value.status_code = 200
@@ -47,7 +46,11 @@ class ShipmentViewSetTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(self.shipment1.status, "paid")
         self.assertIn("Shipment", response.data["message"])
-        mock_publish.assert_called_once()
+
+        # Event is written to the outbox in the same transaction
+        event = OutboxEvent.objects.get()
+        self.assertEqual(event.event_type, "shipment.paid")
+        self.assertEqual(event.payload["order_id"], 101)
 
     
     @patch("requests.get") 
@@ -0,0 +1,97 @@
+from concurrent.futures import Future
+from types import SimpleNamespace
+from django.test import SimpleTestCase
+from pika.spec import Basic
+from unittest.mock import patch, MagicMock
+from pika.exceptions import AMQPConnectionError
+from apps.shipping.publisher import ConfirmPublisher, PublishNacked, PublishReturned
+
+
+class ConfirmPublisherTests(SimpleTestCase):
+    def setUp(self):
+        self.publisher = ConfirmPublisher("rabbitmq", "guest", "guest", "shipping_events", max_in_flight=3)
+
+    def _track(self, tag):
+        future = Future()
+        self.publisher._window.acquire()
+        self.publisher._pending[tag] = (future, 0.0, f"msg-{tag}")
+        return future
+
+    def _frame(self, method_class, tag, multiple=False):
+        return SimpleNamespace(method=method_class(delivery_tag=tag, multiple=multiple))
+
+    def test_multiple_ack_resolves_all_earlier_tags(self):
+        futures = [self._track(tag) for tag in (1, 2, 3)]
+
+        self.publisher._on_confirm(self._frame(Basic.Ack, 2, multiple=True))
+
+        self.assertTrue(futures[0].result())
+        self.assertTrue(futures[1].result())
+        self.assertFalse(futures[2].done())
+        self.assertEqual(list(self.publisher._pending), [3])
+
+    def test_nack_fails_only_that_message(self):
+        first, second = self._track(1), self._track(2)
+
+        self.publisher._on_confirm(self._frame(Basic.Nack, 2))
+
+        self.assertFalse(first.done())
+        self.assertIsInstance(second.exception(), PublishNacked)
+        # The in-flight window slot is released again
+        self.assertTrue(self.publisher._window.acquire(blocking=False))
+
+    def test_returned_message_fails_despite_its_ack(self):
+        returned, routed = self._track(1), self._track(2)
+
+        self.publisher._on_return(
+            None, Basic.Return(routing_key="shipment.paid", reply_text="NO_ROUTE"),
+            SimpleNamespace(message_id="msg-1"), b"{}",
+        )
+        self.publisher._on_confirm(self._frame(Basic.Ack, 2, multiple=True))
+
+        self.assertIsInstance(returned.exception(), PublishReturned)
+        self.assertTrue(routed.result())
+        self.assertEqual(self.publisher._returned, set())
+
+    def _connected(self):
+        """Pretend the IO loop is up but never runs callbacks, as after a lost connection"""
+        self.publisher._thread = MagicMock(**{"is_alive.return_value": True})
+        self.publisher._connection = MagicMock()
+        self.publisher._ready.set()
+        self.publisher._accepting = True
+
+    def test_loop_shutdown_fails_queued_messages_and_frees_the_window(self):
+        self._connected()
+        futures = [self.publisher.publish(b"{}", routing_key="shipment.paid") for _ in range(3)]
+        self.assertFalse(any(f.done() for f in futures))
+
+        self.publisher._shutdown(AMQPConnectionError("lost"))
+
+        self.assertTrue(all(isinstance(f.exception(), AMQPConnectionError) for f in futures))
+        for _ in range(3):
+            self.assertTrue(self.publisher._window.acquire(blocking=False))
+        for _ in range(3):
+            self.publisher._window.release()
+        # Refused rather than queued on a loop that will never run it
+        self.publisher._ready.set()
+        future = self.publisher.publish(b"{}", routing_key="shipment.paid")
+        self.assertIsInstance(future.exception(), AMQPConnectionError)
+
+    def test_publish_gives_up_when_the_window_stays_full(self):
+        self._connected()
+        self.publisher.window_timeout = 0.01
+        for _ in range(3):
+            self.publisher.publish(b"{}", routing_key="shipment.paid")
+
+        with self.assertRaises(AMQPConnectionError):
+            self.publisher.publish(b"{}", routing_key="shipment.paid")
+
+    def test_start_refuses_while_the_old_io_thread_holds_the_connection(self):
+        self.publisher.connect_timeout = 0.01
+        self.publisher._thread = MagicMock(**{"is_alive.return_value": True})
+        self.publisher._connection = MagicMock()
+
+        with patch("apps.shipping.publisher.threading.Thread") as thread:
+            with self.assertRaises(AMQPConnectionError):
+                self.publisher.start()
+        thread.assert_not_called()
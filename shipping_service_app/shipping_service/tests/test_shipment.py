@@ -3,7 +3,7 @@ from django.contrib.auth import get_user_model
 from rest_framework.test import APIClient
 from rest_framework import status
 from unittest.mock import patch
-from apps.shipping.models import Shipment
+from apps.shipping.models import Shipment, OutboxEvent
 
 User = get_user_model()
 
@@ -26,8 +26,7 @@ class ShipmentViewSetTests(TestCase):
             print(f"id={s.id}, user_id={s.user_id}, order_id={s.order_id}, status={s.status}")
 
     @patch("requests.get")
-    @patch("apps.shipping.views.publish_event")  # Mock RMQ event publisher
-    def test_appoint_order_creates_new_shipment(self, mock_publish, mock_get):
+    def test_appoint_order_creates_new_shipment(self, mock_get):
         """User can appoint an order to create a shipment."""
         # Mock order service response
         mock_get.return_value.status_code = 200
@@ -50,5 +49,5 @@ class ShipmentViewSetTests(TestCase):
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
         self.assertTrue(Shipment.objects.filter(order_id=999).exists())
 
-        # Ensure RMQ event was published
-        mock_publish.assert_called_once()
+        # Ensure the event was written to the outbox
+        self.assertEqual(OutboxEvent.objects.filter(event_type="shipment.updated").count(), 1)
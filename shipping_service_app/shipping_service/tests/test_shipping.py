@@ -37,8 +37,7 @@ class ShipmentShipTests(TestCase):
             order_id=102,
             status='pending'  # cannot ship yet
         )
-    @patch("apps.shipping.views.publish_event")  # mock RMQ publisher
-    def test_admin_can_ship(self, mock_publish):
+    def test_admin_can_ship(self):
         # Authenticate as admin
         self.client.force_authenticate(user=self.admin_user)
 
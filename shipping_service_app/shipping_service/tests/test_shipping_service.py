@@ -1,15 +1,25 @@
+import json
+import time
 from django.test import TestCase
 from rest_framework.test import APIClient
 from rest_framework import status
 from types import SimpleNamespace
 from django.core.cache import cache
+from django_redis import get_redis_connection
 from unittest.mock import patch
 from apps.shipping.models import Shipment
+from apps.shipping import cache_utils
+from apps.shipping.cache_metrics import CacheMetrics
+from apps.shipping.cache_utils import (
+    get_cache_key, get_cached_response, get_generation, get_generation_key, invalidate_cache,
+    local_cache, set_cached_response,
+)
 
 class ShipmentViewSetTests(TestCase):
     def setUp(self):
         # Clear cache before each test
         cache.clear()
+        local_cache.clear()
 
         # Mock users (ServiceJWTAuthentication-like)
         self.admin_user = SimpleNamespace(id=1, is_authenticated=True, is_admin=True)
@@ -26,15 +36,16 @@ class ShipmentViewSetTests(TestCase):
         self.client.force_authenticate(user=self.normal_user)
         response = self.client.get('/api/shipments/my_shipments/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
-        for shipment in response.data:
+        shipments = json.loads(response.content)
+        self.assertEqual(len(shipments), 2)
+        for shipment in shipments:
             self.assertEqual(shipment["user_id"], self.normal_user.id)
 
     def test_all_shipments_admin_only(self):
         self.client.force_authenticate(user=self.admin_user)
         response = self.client.get('/api/shipments/all_shipments/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 3)
+        self.assertEqual(len(json.loads(response.content)), 3)
 
     def test_all_shipments_forbidden_for_normal_user(self):
         self.client.force_authenticate(user=self.normal_user)
@@ -69,7 +80,7 @@ class ShipmentViewSetTests(TestCase):
             self.assertTrue(found_hit, "Cache HIT should be logged")
 
         # Responses should be identical
-        self.assertEqual(response1.data, response2.data)
+        self.assertEqual(json.loads(response1.content), json.loads(response2.content))
 
     def test_cache_invalidation_after_update(self):
         """Cache should be invalidated after updating a shipment."""
@@ -78,6 +89,7 @@ class ShipmentViewSetTests(TestCase):
         # Prime the cache
         self.client.get('/api/shipments/all_shipments/')
         self.assertTrue(any("all_shipments" in key for key in cache.keys('*')))
+        generation = cache.get("all_shipments_generation")
 
         # Update shipment → should invalidate cache
         response = self.client.patch(
@@ -87,5 +99,224 @@ class ShipmentViewSetTests(TestCase):
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
-        # Cache should now be cleared
-        self.assertEqual(len(cache.keys('*')), 0)
+        # Namespace generation bumped: the old entry is no longer served
+        self.assertEqual(cache.get("all_shipments_generation"), generation + 1)
+        with patch("apps.shipping.cache_utils.logger.info") as mock_log:
+            response = self.client.get('/api/shipments/all_shipments/')
+            self.assertFalse(any("[CACHE HIT]" in str(call) for call in mock_log.call_args_list))
+        shipment = next(s for s in json.loads(response.content) if s["id"] == self.shipment1.id)
+        self.assertEqual(shipment["status"], "paid")
+
+    def test_repeat_hit_is_served_from_local_tier(self):
+        self.client.force_authenticate(user=self.normal_user)
+        self.client.get('/api/shipments/my_shipments/')
+
+        with patch("apps.shipping.cache_utils.cache.get") as redis_get, \
+                patch("apps.shipping.cache_utils.logger.info") as mock_log:
+            self.client.get('/api/shipments/my_shipments/')
+            redis_get.assert_not_called()
+            self.assertTrue(any("tier=local" in str(call) for call in mock_log.call_args_list))
+
+    def test_invalidation_evicts_local_generation(self):
+        self.client.force_authenticate(user=self.normal_user)
+        self.client.get('/api/shipments/my_shipments/')
+        key = f"my_shipments_{self.normal_user.id}_generation"
+        self.assertEqual(local_cache.get(key), cache.get(key))
+
+        invalidate_cache("my_shipments", self.normal_user.id)
+        self.assertIsNone(local_cache.get(key))
+        with patch("apps.shipping.cache_utils.logger.info") as mock_log:
+            self.client.get('/api/shipments/my_shipments/')
+            self.assertFalse(any("[CACHE HIT]" in str(call) for call in mock_log.call_args_list))
+
+    def test_cached_list_sends_etag_and_answers_if_none_match(self):
+        self.client.force_authenticate(user=self.normal_user)
+        response = self.client.get('/api/shipments/my_shipments/')
+        etag = response["ETag"]
+        self.assertEqual(response["Content-Type"], "application/json")
+
+        # Same bytes from the cache, or nothing at all if the client has them
+        self.assertEqual(self.client.get('/api/shipments/my_shipments/')["ETag"], etag)
+        response = self.client.get('/api/shipments/my_shipments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response.content, b"")
+
+        # A write changes the list, so the old ETag no longer matches
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.patch(
+            f'/api/shipments/{self.shipment2.id}/update_shipment/', {"status": "shipped"}, format='json'
+        )
+        self.client.force_authenticate(user=self.normal_user)
+        response = self.client.get('/api/shipments/my_shipments/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_cache_metrics_per_prefix(self):
+        metrics = CacheMetrics()
+        self.client.force_authenticate(user=self.normal_user)
+        with patch.object(cache_utils, "cache_metrics", metrics):
+            self.client.get('/api/shipments/my_shipments/')
+            self.client.get('/api/shipments/my_shipments/')
+            invalidate_cache("my_shipments", self.normal_user.id)
+
+        self.assertEqual(metrics.misses["my_shipments"], 1)
+        self.assertEqual(metrics.hits[("my_shipments", "local")], 1)
+        self.assertEqual(metrics.invalidations["my_shipments"], 1)
+        self.assertEqual(metrics.fill_latency["my_shipments"].count, 1)
+        self.assertGreater(metrics.payload_bytes["my_shipments"].sum, 0)
+        self.assertGreater(metrics.redis_latency["set"].count, 0)
+
+        rendered = metrics.render()
+        self.assertIn('shipping_cache_hits_total{prefix="my_shipments",tier="local"} 1', rendered)
+        self.assertIn('shipping_cache_misses_total{prefix="my_shipments"} 1', rendered)
+
+    def test_metrics_endpoint(self):
+        with patch("apps.shipping.cache_metrics.METRICS_TOKEN", "scrape-me"):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION="Bearer scrape-me")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(b"# TYPE shipping_cache_hits_total counter", response.content)
+
+    def test_metrics_endpoint_requires_the_token(self):
+        with patch("apps.shipping.cache_metrics.METRICS_TOKEN", "scrape-me"):
+            self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_401_UNAUTHORIZED)
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION="Bearer guess")
+            self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        # Not configured: not served at all
+        with patch("apps.shipping.cache_metrics.METRICS_TOKEN", ""):
+            response = self.client.get('/metrics', HTTP_AUTHORIZATION="Bearer ")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_server_timing_header(self):
+        self.client.force_authenticate(user=self.normal_user)
+        with patch.object(cache_utils, "SERVER_TIMING", True):
+            miss = self.client.get('/api/shipments/my_shipments/')
+            hit = self.client.get('/api/shipments/my_shipments/')
+        self.assertTrue(miss["Server-Timing"].startswith('cache;desc="miss", fill;dur='))
+        self.assertTrue(hit["Server-Timing"].startswith('cache;desc="hit-local";dur='))
+
+    def test_large_entries_are_compressed_transparently(self):
+        self.client.force_authenticate(user=self.admin_user)
+        with patch.object(cache_utils, "COMPRESS_MIN_BYTES", 0), \
+                patch.object(cache_utils, "COMPRESSION", "zlib"):
+            response1 = self.client.get('/api/shipments/all_shipments/')
+            key = next(k for k in cache.keys('all_shipments_*') if not k.endswith(("_generation", "_lock")))
+            self.assertEqual(cache.get(key)["encoding"], "zlib")
+
+            # Served from Redis, not the local tier: decompressed on read
+            local_cache.clear()
+            response2 = self.client.get('/api/shipments/all_shipments/')
+        self.assertEqual(response1.content, response2.content)
+        self.assertEqual(response1["ETag"], response2["ETag"])
+
+    def _list_request(self, user):
+        return SimpleNamespace(user=user, META={}, get_full_path=lambda: "/api/shipments/all_shipments/")
+
+    def test_concurrent_miss_waits_for_the_fill(self):
+        filler, waiter = self._list_request(self.admin_user), self._list_request(self.admin_user)
+        self.assertIsNone(get_cached_response("all_shipments", filler))
+
+        # The waiter polls while the filler finishes its query
+        def fill(_):
+            set_cached_response("all_shipments", filler, [{"id": 1}])
+        with patch("apps.shipping.cache_utils.time.sleep", side_effect=fill) as sleep:
+            response = get_cached_response("all_shipments", waiter)
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(json.loads(response.content), [{"id": 1}])
+        lock_key = cache.make_key(get_cache_key("all_shipments", filler) + "_lock")
+        self.assertFalse(get_redis_connection("default").exists(lock_key))
+
+    def test_expired_lease_taken_over_is_not_released_by_its_old_owner(self):
+        slow, other = self._list_request(self.admin_user), self._list_request(self.admin_user)
+        self.assertIsNone(get_cached_response("all_shipments", slow))
+
+        # The slow fill outlives its lease and another request takes it over
+        lock_key = cache.make_key(get_cache_key("all_shipments", slow) + "_lock")
+        redis = get_redis_connection("default")
+        redis.delete(lock_key)
+        self.assertIsNone(get_cached_response("all_shipments", other))
+        new_token = redis.get(lock_key)
+
+        set_cached_response("all_shipments", slow, [{"id": 1}])
+        self.assertEqual(redis.get(lock_key), new_token)
+
+    def test_waiter_that_gives_up_records_its_own_query_time(self):
+        self.assertIsNone(get_cached_response("all_shipments", self._list_request(self.admin_user)))
+        waiter = self._list_request(self.admin_user)
+        with patch.object(cache_utils, "FILL_WAIT", 0.01), \
+                patch.object(cache_utils, "FILL_POLL_INTERVAL", 0.001):
+            self.assertIsNone(get_cached_response("all_shipments", waiter))
+        cache_key = get_cache_key("all_shipments", waiter)
+        time.sleep(0.01)  # the query
+        set_cached_response("all_shipments", waiter, [{"id": 1}])
+        self.assertGreaterEqual(local_cache.get(cache_key)["delta"], 0.01)
+
+    def test_entry_without_a_fill_is_never_refreshed_early(self):
+        request = self._list_request(self.admin_user)
+        set_cached_response("all_shipments", request, [{"id": 1}])
+        entry = local_cache.get(get_cache_key("all_shipments", request))
+        self.assertIsNone(entry["delta"])
+
+        entry["expiry"] = time.time() + 0.001
+        with patch.object(cache_utils, "XFETCH_BETA", 1e9):
+            self.assertFalse(cache_utils._should_refresh_early(entry))
+
+    def test_waiter_recomputes_when_the_fill_never_comes(self):
+        self.assertIsNone(get_cached_response("all_shipments", self._list_request(self.admin_user)))
+        with patch.object(cache_utils, "FILL_WAIT", 0.01), \
+                patch.object(cache_utils, "FILL_POLL_INTERVAL", 0.001):
+            self.assertIsNone(get_cached_response("all_shipments", self._list_request(self.admin_user)))
+
+    def test_entry_near_expiry_is_refreshed_by_one_request(self):
+        request = self._list_request(self.admin_user)
+        get_cached_response("all_shipments", request)
+        set_cached_response("all_shipments", request, [{"id": 1}])
+
+        with patch("apps.shipping.cache_utils._should_refresh_early", return_value=True):
+            self.assertIsNone(get_cached_response("all_shipments", self._list_request(self.admin_user)))
+            # The lease is taken, so everyone else keeps getting the current entry
+            response = get_cached_response("all_shipments", self._list_request(self.admin_user))
+        self.assertEqual(json.loads(response.content), [{"id": 1}])
+
+    def test_write_only_invalidates_the_owners_my_shipments(self):
+        """Another user's my_shipments cache survives a write to someone else's shipment."""
+        self.client.force_authenticate(user=self.normal_user)
+        self.client.get('/api/shipments/my_shipments/')
+
+        self.client.force_authenticate(user=self.admin_user)
+        self.client.patch(
+            f'/api/shipments/{self.shipment1.id}/update_shipment/', {"status": "paid"}, format='json'
+        )
+
+        self.client.force_authenticate(user=self.normal_user)
+        with patch("apps.shipping.cache_utils.logger.info") as mock_log:
+            self.client.get('/api/shipments/my_shipments/')
+            self.assertTrue(any("[CACHE HIT]" in str(call) for call in mock_log.call_args_list))
+
+    def test_ownership_transfer_invalidates_old_and_new_owner(self):
+        generations = {
+            (prefix, user_id): get_generation(prefix, user_id)
+            for prefix, user_id in (("my_shipments", self.admin_user.id),
+                                    ("my_shipments", self.normal_user.id),
+                                    ("all_shipments", None))
+        }
+        self.client.force_authenticate(user=self.admin_user)
+        response = self.client.patch(
+            f'/api/shipments/{self.shipment1.id}/update_shipment/',
+            {"user_id": self.normal_user.id},
+            format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for (prefix, user_id), generation in generations.items():
+            self.assertEqual(cache.get(get_generation_key(prefix, user_id)), generation + 1)
+
+    def test_evicted_generation_never_restarts_at_a_used_value(self):
+        old = get_generation("all_shipments")
+        invalidate_cache("all_shipments")
+
+        # Evicted under maxmemory, then bumped again before anyone reads it
+        cache.delete("all_shipments_generation")
+        local_cache.clear()
+        invalidate_cache("all_shipments")
+
+        self.assertGreater(get_generation("all_shipments"), old + 1)
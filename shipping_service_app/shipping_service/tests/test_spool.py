@@ -0,0 +1,122 @@
+import tempfile
+from concurrent.futures import Future
+from django.test import SimpleTestCase, TestCase
+from unittest.mock import MagicMock, patch
+from pika.exceptions import AMQPConnectionError
+from apps.shipping import utils
+from apps.shipping.models import OutboxEvent
+from apps.shipping.publisher import PublishNacked
+from apps.shipping.spool import EventSpool, SpoolFull
+
+
+class EventSpoolTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = EventSpool(self.tmp.name, segment_bytes=64, fsync_every=2)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp.cleanup()
+
+    def test_replays_in_order_across_segments(self):
+        for i in range(10):
+            self.spool.append(f'{{"n": {i}}}')
+
+        published = []
+        count = self.spool.replay(published.append)
+
+        self.assertEqual(count, 10)
+        self.assertEqual(published, [f'{{"n": {i}}}'.encode() for i in range(10)])
+        self.assertFalse(self.spool.has_pending())
+
+    def test_failed_replay_resumes_from_checkpoint(self):
+        for i in range(3):
+            self.spool.append(f"event-{i}")
+
+        published = []
+
+        def flaky_publish(body):
+            if body == b"event-1" and b"event-1" not in failed:
+                failed.append(body)
+                raise AMQPConnectionError("broker down")
+            published.append(body)
+
+        failed = []
+        with self.assertRaises(AMQPConnectionError):
+            self.spool.replay(flaky_publish)
+        self.spool.replay(flaky_publish)
+
+        self.assertEqual(published, [b"event-0", b"event-1", b"event-2"])
+
+    def test_torn_trailing_record_is_skipped(self):
+        self.spool.append("complete")
+        self.spool.close()
+        segment = next(self.spool.directory.glob("*.spool"))
+        with open(segment, "ab") as f:
+            f.write(b"\x00\x00\x00\x10garbage")
+
+        published = []
+        self.spool.replay(published.append)
+
+        self.assertEqual(published, [b"complete"])
+
+    def test_size_limit(self):
+        spool = EventSpool(self.tmp.name, segment_bytes=16, max_bytes=32)
+        spool.append("x" * 20)
+        with self.assertRaises(SpoolFull):
+            spool.append("x" * 20)
+
+
+class SpoolReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.spool = EventSpool(self.tmp.name)
+
+    def tearDown(self):
+        self.spool.close()
+        self.tmp.cleanup()
+
+    @patch("apps.shipping.utils.get_spool_publisher")
+    def test_replay_waits_for_the_confirm(self, mock_get_publisher):
+        future = Future()
+        future.set_exception(PublishNacked("nacked"))
+        mock_get_publisher.return_value.publish.return_value = future
+        body, _ = utils.encode_event("shipment.paid", {"order_id": 101})
+        self.spool.append(body)
+
+        with self.assertRaises(PublishNacked):
+            self.spool.replay(utils.publish_spooled)
+        # Still spooled for the next attempt
+        self.assertTrue(self.spool.has_pending())
+
+    @patch("apps.shipping.utils.close_old_connections")
+    @patch("apps.shipping.utils.time.sleep")
+    def test_replayer_backs_off_while_segments_are_locked(self, mock_sleep, _):
+        spool = MagicMock()
+        spool.has_pending.side_effect = [True, True, False]
+        spool.replay.return_value = 0  # every segment held by another writer
+
+        with patch.object(utils, "spool", spool):
+            utils._replay_spool()
+
+        self.assertEqual(mock_sleep.call_count, 2)
+
+
+class PublishSpooledTests(TestCase):
+    @patch("apps.shipping.utils.get_spool_publisher")
+    def test_confirmed_replay_marks_the_outbox_row_sent(self, mock_get_publisher):
+        future = Future()
+        future.set_result(True)
+        publish = mock_get_publisher.return_value.publish
+        publish.return_value = future
+        event = OutboxEvent.objects.create(event_type="shipment.paid", payload={"order_id": 101})
+        body, expected = utils.encode_event(event.event_type, event.payload, event.event_id)
+
+        utils.publish_spooled(body)
+
+        properties = publish.call_args.kwargs["properties"]
+        self.assertEqual(publish.call_args.kwargs["routing_key"], "shipment.paid")
+        for name in ("content_type", "message_id", "type", "timestamp", "priority", "delivery_mode"):
+            self.assertEqual(getattr(properties, name), getattr(expected, name))
+        event.refresh_from_db()
+        self.assertIsNotNone(event.sent_at)